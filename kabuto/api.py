@@ -1,35 +1,112 @@
+import base64
+import codecs
 import datetime
+import hashlib
+import hmac
+import itertools
 import json
+import threading
 import logging
+import mimetypes
 import os
+import shutil
 import uuid
 import zipfile
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from flask import abort, send_file, request
+from types import SimpleNamespace
+from flask import abort, send_file, request, Response
 from flask_login import (login_required, login_user,
                          current_user)
 from flask_restful import reqparse
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine.reflection import Inspector
 from werkzeug.datastructures import FileStorage
+from werkzeug.wsgi import wrap_file
 import flask_restful as restful
 from flask_ldap3_login import AuthenticationResponseStatus as ars
 import time
 
-from utils import make_app, get_working_dir, logger
-from tasks import build_and_push, get_docker_client, LogHandler
+from utils import (make_app, get_working_dir, logger, FileSlice,
+                   save_upload)
+from tasks import build_and_push, LogHandler, DOCKER, context_hash
 from connection import Receiver, Sender
+from archives import (BundleCache, stream_folder_as_zip, zip_listing,
+                      stream_zip_member, stream_zip, folder_entries,
+                      prefixed_entries)
+from uploads import UploadSession, UploadError
+from blobs import BlobStore
+from directory import CredentialCache, DirectoryBusy
 
 app, api, login_manager, ldap_manager, db, bcrypt = make_app()
 SENDER = Sender('jobs', app.config)
+BUNDLES = BundleCache(app.config)
+BLOBS = BlobStore(app.config)
+# results are checked off the request thread, the worker posting them
+# only waits for the upload to be on disk
+INGESTER = ThreadPoolExecutor(max_workers=app.config['INGEST_WORKERS'])
 
 
 class ProtectedResource(restful.Resource):
     method_decorators = [login_required]
 
 DATE_FORMAT = "%Y-%m-%d"
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+def format_date(value):
+    if value is None:
+        return None
+    return value.strftime(DATE_FORMAT)
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+class Serializable(object):
+    # columns needed by row_as_dict, so listings can select just
+    # those instead of loading full objects
+    DICT_COLUMNS = ('id',)
+    # fields of the dict named differently than their column
+    FIELD_COLUMNS = {}
+
+    @classmethod
+    def column_names(cls, fields=None):
+        if not fields:
+            return cls.DICT_COLUMNS
+        wanted = set(cls.FIELD_COLUMNS.get(field, field) for field in fields)
+        wanted.add('id')
+        return [name for name in cls.DICT_COLUMNS if name in wanted]
+
+    @classmethod
+    def query_rows(cls, query, fields=None):
+        names = cls.column_names(fields)
+        rows = query.with_entities(*[getattr(cls, name) for name in names])
+        # columns that were not selected read as None
+        blank = dict.fromkeys(cls.DICT_COLUMNS)
+        return [SimpleNamespace(**dict(blank, **dict(zip(names, row))))
+                for row in rows]
+
+    @staticmethod
+    def restrict(entity_dict, fields):
+        if not fields:
+            return entity_dict
+        return dict((key, value) for key, value in entity_dict.items()
+                    if key in fields or key == 'id')
+
+    @classmethod
+    def query_as_dict(cls, query, fields=None):
+        return dict((row.id, cls.restrict(cls.row_as_dict(row), fields))
+                    for row in cls.query_rows(query, fields))
+
+    def as_dict(self):
+        return self.row_as_dict(self)
 
 
 def get_remote_ip():
@@ -77,7 +154,49 @@ class User(db.Model):
         return self.login
 
 
-class Image(db.Model):
+class ApiToken(db.Model):
+    # long lived credentials for scripts, only a keyed hash is stored
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128))
+    digest = db.Column(db.String(64), unique=True, index=True)
+    creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    user = db.relationship('User',
+                           backref=db.backref('tokens', lazy='dynamic'))
+
+    def __init__(self, name, user_id):
+        self.name = name
+        self.user_id = user_id
+
+    @staticmethod
+    def hash(token):
+        # tokens are random, a keyed sha256 is enough, no need for bcrypt
+        return hmac.new(app.config['SECRET_KEY'].encode('utf-8'),
+                        token.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def generate(self):
+        token = base64.urlsafe_b64encode(os.urandom(32)).decode('ascii')
+        token = token.rstrip('=')
+        self.digest = self.hash(token)
+        return token
+
+
+class BlobOwner(db.Model):
+    # users who stored a blob, only they can see and link it
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    __table_args__ = (db.Index('ix_blob_owner_digest_user',
+                               'digest', 'user_id'),)
+
+    def __init__(self, digest, user_id):
+        self.digest = digest
+        self.user_id = user_id
+
+
+class Image(db.Model, Serializable):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     dockerfile = db.Column(db.Text)
@@ -85,55 +204,124 @@ class Image(db.Model):
     tag = db.Column(db.String(128))
     creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow())
 
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     owner = db.relationship('User',
                             backref=db.backref('images', lazy='dynamic'))
 
     def __init__(self, dockerfile, name, owner):
         self.dockerfile = dockerfile
         self.name = name
-        self.owner = owner
+        self.owner_id = owner.id
 
-    def as_dict(self):
-        return {"id": self.id,
-                "name": self.name,
-                "dockerfile": self.dockerfile,
-                "creation_date": self.creation_date.strftime(DATE_FORMAT)}
+    DICT_COLUMNS = ('id', 'name', 'dockerfile', 'creation_date')
+
+    @staticmethod
+    def row_as_dict(row):
+        return {"id": row.id,
+                "name": row.name,
+                "dockerfile": row.dockerfile,
+                "creation_date": format_date(row.creation_date)}
+
+
+class Build(db.Model):
+    # an image build waiting for, or holding, a build slot
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String(36), unique=True)
+    state = db.Column(db.String(32), default='queued', index=True)
+    priority = db.Column(db.Integer, default=0)
+    name = db.Column(db.String(128))
+    args = db.Column(db.Text)
+    context_hash = db.Column(db.String(64), index=True)
+    result = db.Column(db.Text)
+    creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_date = db.Column(db.DateTime)
+    finished_date = db.Column(db.DateTime)
+
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    owner = db.relationship('User',
+                            backref=db.backref('builds', lazy='dynamic'))
+
+    __table_args__ = (db.Index('ix_build_owner_name', 'owner_id', 'name'),)
 
+    def __init__(self, args, owner, priority=0):
+        self.task_id = str(uuid.uuid4())
+        self.name = args.get('name')
+        self.args = json.dumps(args)
+        self.owner_id = owner.id
+        self.priority = priority
+        self.state = 'queued'
 
-class Pipeline(db.Model):
+
+class Pipeline(db.Model, Serializable):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow())
 
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     owner = db.relationship('User',
                             backref=db.backref('pipelines', lazy='dynamic'))
 
     def __init__(self, name, owner):
         self.name = name
-        self.owner = owner
+        self.owner_id = owner.id
+
+    DICT_COLUMNS = ('id', 'name', 'creation_date')
+
+    @staticmethod
+    def row_as_dict(row, jobs):
+        return {"id": row.id,
+                "name": row.name,
+                "creation_date": format_date(row.creation_date),
+                "jobs": jobs}
+
+    @classmethod
+    def query_as_dict(cls, query, fields=None):
+        rows = cls.query_rows(query, fields)
+        jobs = {}
+        if not fields or 'jobs' in fields:
+            # all the job ids in one query rather than one per pipeline
+            pipeline_ids = query.with_entities(Pipeline.id).subquery()
+            job_query = db.session.query(Job.pipeline_id, Job.id)
+            job_query = job_query.filter(Job.pipeline_id.in_(pipeline_ids))
+            for pipeline_id, job_id in job_query.order_by(Job.id):
+                jobs.setdefault(pipeline_id, []).append({"id": job_id})
+        return dict((row.id, cls.restrict(cls.row_as_dict(
+                        row, jobs.get(row.id, [])), fields))
+                    for row in rows)
 
     def as_dict(self):
         jobs = [{"id": j.id} for j in Job.query.filter_by(pipeline=self)]
-        return {"id": self.id,
-                "name": self.name,
-                "creation_date": self.creation_date.strftime(DATE_FORMAT),
-                "jobs": jobs}
+        return self.row_as_dict(self, jobs)
+
+
+job_dependency = db.Table(
+    'job_dependency',
+    db.Column('job_id', db.Integer, db.ForeignKey('job.id'),
+              primary_key=True),
+    db.Column('depends_on_id', db.Integer, db.ForeignKey('job.id'),
+              primary_key=True, index=True))
+
+job_input = db.Table(
+    'job_input',
+    db.Column('job_id', db.Integer, db.ForeignKey('job.id'),
+              primary_key=True),
+    db.Column('input_id', db.Integer, db.ForeignKey('job.id'),
+              primary_key=True, index=True))
 
 
-class Job(db.Model):
+class Job(db.Model, Serializable):
     id = db.Column(db.Integer, primary_key=True)
-    image_id = db.Column(db.Integer, db.ForeignKey('image.id'))
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)
     image = db.relationship('Image',
                             backref=db.backref('jobs', lazy='dynamic'))
 
-    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipeline.id'))
+    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipeline.id'),
+                            index=True)
     pipeline = db.relationship('Pipeline',
                                backref=db.backref('jobs', lazy='dynamic'))
 
     command = db.Column(db.Text)
-    state = db.Column(db.String(32), default='ready')
+    state = db.Column(db.String(32), default='ready', index=True)
     creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow())
     response = db.Column(db.Integer)
     used_cpu = db.Column(db.Float(precision=2), default=0.)
@@ -141,13 +329,31 @@ class Job(db.Model):
     used_io = db.Column(db.Float(precision=2), default=0.)
 
     attachments_path = db.Column(db.String(128))
-    attachments_token = db.Column(db.String(36))
-    results_token = db.Column(db.String(36))
+    attachments_token = db.Column(db.String(36), index=True)
+    results_token = db.Column(db.String(36), index=True)
     results_path = db.Column(db.String(128))
 
     sequence_number = db.Column(db.Integer)
     container_id = db.Column(db.String(128))
 
+    # jobs whose results this one waits for, when left empty it waits for
+    # the jobs with a lower sequence number in its pipeline
+    dependencies = db.relationship(
+        'Job', secondary=job_dependency,
+        primaryjoin=(id == job_dependency.c.job_id),
+        secondaryjoin=(id == job_dependency.c.depends_on_id),
+        backref='dependents')
+    # jobs whose results are added to this one's attachments, under
+    # job_<id>/; the job waits for them like for its dependencies
+    inputs = db.relationship(
+        'Job', secondary=job_input,
+        primaryjoin=(id == job_input.c.job_id),
+        secondaryjoin=(id == job_input.c.input_id),
+        backref='consumers')
+
+    __table_args__ = (db.Index('ix_job_pipeline_sequence',
+                               'pipeline_id', 'sequence_number'),)
+
     def __init__(self, pipeline, image, attachments, command, sequence=None):
         self.pipeline = pipeline
         self.image = image
@@ -156,7 +362,7 @@ class Job(db.Model):
         self.attachments_token = str(uuid.uuid4())
         self.results_token = str(uuid.uuid4())
         self.results_path = get_working_dir(prefix='kabuto-outbox-')
-        if not sequence:
+        if sequence is None:
             self.sequence_number = len(pipeline.jobs.all()) - 1
         else:
             self.sequence_number = sequence
@@ -169,27 +375,116 @@ class Job(db.Model):
                            'result_token': self.results_token,
                            'image_tag': self.image.tag})
 
+    DICT_COLUMNS = ('id', 'command', 'state', 'creation_date', 'response',
+                    'used_cpu', 'used_memory', 'used_io', 'attachments_token',
+                    'results_path', 'image_id', 'pipeline_id',
+                    'sequence_number')
+    FIELD_COLUMNS = {'attachment_token': 'attachments_token',
+                     'image': 'image_id',
+                     'pipeline': 'pipeline_id'}
+
+    @staticmethod
+    def row_as_dict(row, depends_on, inputs):
+        return {"id": row.id,
+                "command": row.command,
+                "state": row.state,
+                "creation_date": format_date(row.creation_date),
+                "response": row.response,
+                "used_cpu": row.used_cpu,
+                "used_memory": row.used_memory,
+                "used_io": row.used_io,
+                "attachment_token": row.attachments_token,
+                "results_path": row.results_path,
+                "image": {"id": row.image_id},
+                "pipeline": {"id": row.pipeline_id},
+                "sequence_number": row.sequence_number,
+                "depends_on": depends_on,
+                "inputs": inputs}
+
+    @classmethod
+    def query_as_dict(cls, query, fields=None):
+        rows = cls.query_rows(query, fields)
+        links = {}
+        for field, table, column in (('depends_on', job_dependency,
+                                      job_dependency.c.depends_on_id),
+                                     ('inputs', job_input,
+                                      job_input.c.input_id)):
+            links[field] = {}
+            if fields and field not in fields:
+                continue
+            job_ids = query.with_entities(Job.id).subquery()
+            link_query = db.session.query(table.c.job_id, column)
+            link_query = link_query.filter(table.c.job_id.in_(job_ids))
+            for job_id, linked_id in link_query.order_by(column):
+                links[field].setdefault(job_id, []).append(linked_id)
+        return dict((row.id, cls.restrict(cls.row_as_dict(
+                        row, links['depends_on'].get(row.id, []),
+                        links['inputs'].get(row.id, [])), fields))
+                    for row in rows)
+
     def as_dict(self):
-        return {"id": self.id,
-                "command": self.command,
-                "state": self.state,
-                "creation_date": self.creation_date.strftime(DATE_FORMAT),
-                "response": self.response,
-                "used_cpu": self.used_cpu,
-                "used_memory": self.used_memory,
-                "used_io": self.used_io,
-                "attachment_token": self.attachments_token,
-                "results_path": self.results_path,
-                "image": {"id": self.image_id},
-                "pipeline": {"id": self.pipeline_id}}
+        return self.row_as_dict(self, sorted(j.id for j in self.dependencies),
+                                sorted(j.id for j in self.inputs))
 
     @property
     def owner(self):
         return self.pipeline.owner
 
+    @property
+    def results_zip(self):
+        # the archive posted by the worker, kept as is and served from
+        return os.path.join(self.results_path, 'results.zip')
+
 
-@login_manager.user_loader
-def load_user(login):
+class CachedUser(namedtuple('CachedUser', 'id login email source')):
+    # what requests need of the logged in user, without a session
+    def is_active(self):
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return self.login
+
+
+class UserCache(object):
+    # logged in users for USER_CACHE_TTL seconds, so requests do not hit
+    # the database to know who is calling; every process has its own,
+    # changes to a user invalidate it in the process making them
+    def __init__(self, ttl, loader):
+        self.ttl = ttl
+        self.loader = loader
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            cached = self.users.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+        user = self.loader(key)
+        if user is None:
+            return None
+        record = CachedUser(user.id, user.login, user.email, user.source)
+        with self.lock:
+            self.users[key] = (record, now + self.ttl)
+        return record
+
+    def invalidate(self, key):
+        with self.lock:
+            self.users.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+
+
+def get_user(login):
     try:
         user = User.query.filter_by(login=login).one()
     except NoResultFound:
@@ -197,43 +492,121 @@ def load_user(login):
     return user
 
 
+def get_token_user(digest):
+    query = db.session.query(User).join(ApiToken)
+    return query.filter(ApiToken.digest == digest).first()
+
+
+USERS = UserCache(app.config['USER_CACHE_TTL'], get_user)
+# revoking a token only clears this process' cache, the others keep
+# it for a few seconds
+TOKEN_USERS = UserCache(app.config['TOKEN_CACHE_TTL'], get_token_user)
+# bcrypt is slow on purpose, only a few checks run at once and logins
+# beyond what they can absorb are turned away
+PASSWORD_CHECKS = ThreadPoolExecutor(max_workers=app.config['BCRYPT_WORKERS'])
+PASSWORD_SLOTS = threading.BoundedSemaphore(app.config['BCRYPT_WORKERS'] +
+                                            app.config['BCRYPT_QUEUE'])
+
+
+# logins the directory accepted recently, checked before binding again
+LDAP_LOGINS = CredentialCache(app.config['LDAP_CACHE_TTL'])
+
+
+def follower_slots(config):
+    # every follower keeps a request thread busy until its stream ends,
+    # the other half is left to everything else
+    return min(config['LOG_FOLLOW_MAX'], config['WORKER_THREADS'] // 2)
+
+
+LOG_FOLLOWERS = threading.BoundedSemaphore(follower_slots(app.config))
+
+
+@login_manager.user_loader
+def load_user(login):
+    return USERS.get(login)
+
+
+@login_manager.header_loader
+def load_user_from_header(header):
+    # Authorization: Token <token>
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'token' or not token.strip():
+        return None
+    return TOKEN_USERS.get(ApiToken.hash(token.strip()))
+
+
+def check_password(user, password):
+    if not PASSWORD_SLOTS.acquire(blocking=False):
+        abort(503)
+    try:
+        return PASSWORD_CHECKS.submit(user.is_correct_password,
+                                      password).result()
+    finally:
+        PASSWORD_SLOTS.release()
+
+
 def prepare_entity_dict(entity, entity_id, **kwargs):
-    entity_list = get_entities(entity, entity_id, **kwargs)
-    entity_dict = {}
-    for entity in entity_list:
-        entity_dict[entity.id] = entity.as_dict()
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=int, default=app.config['PAGE_SIZE'])
+    parser.add_argument('after', type=int)
+    parser.add_argument('fields', type=str)
+    parser.add_argument('state', type=str)
+    parser.add_argument('created_after', type=parse_date)
+    parser.add_argument('created_before', type=parse_date)
+    args = parser.parse_args()
+
+    query = query_entities(entity, entity_id, **kwargs)
+    if isinstance(entity, list):
+        entity = entity[0]
+    if args['state'] and hasattr(entity, 'state'):
+        query = query.filter(entity.state == args['state'])
+    if args['created_after']:
+        query = query.filter(entity.creation_date >= args['created_after'])
+    if args['created_before']:
+        query = query.filter(entity.creation_date < args['created_before'])
+    # keyset pagination, the next page starts after the last id we sent
+    if args['after']:
+        query = query.filter(entity.id > args['after'])
+    limit = max(1, min(args['limit'], app.config['MAX_PAGE_SIZE']))
+    query = query.order_by(entity.id).limit(limit + 1)
+
+    fields = None
+    if args['fields']:
+        fields = [field.strip() for field in args['fields'].split(',')]
+    entity_dict = entity.query_as_dict(query, fields)
+    if len(entity_dict) > limit:
+        del entity_dict[max(entity_dict)]
+        return entity_dict, 200, {'X-Next-Cursor': str(max(entity_dict))}
     return entity_dict
 
 
-def get_folder_as_zip(zip_name, folder_to_zip):
-    zip_file = "%s.zip" % os.path.join(get_working_dir(),
-                                       zip_name)
-    zipf = zipfile.ZipFile(zip_file, 'w')
-    if not os.path.isdir(folder_to_zip):
-        raise Exception("%s is not a folder" % folder_to_zip)
-    zipdir(folder_to_zip, zipf,
-           root_folder=folder_to_zip)
-    zipf.close()
-    return zip_file
+def send_zip_stream(chunks, filename):
+    response = Response(chunks, mimetype='application/zip')
+    response.headers['Content-Disposition'] = ('attachment; filename=%s' %
+                                               filename)
+    return response
 
 
 def get_entities(entity, entity_id, **kwargs):
-    kwargs["owner"] = current_user
+    return query_entities(entity, entity_id, **kwargs).all()
+
+
+def query_entities(entity, entity_id, **kwargs):
+    kwargs["owner_id"] = current_user.id
     if entity_id:
         kwargs["id"] = entity_id
     if isinstance(entity, list):
         base_class, join_class = entity
         query = db.session.query(base_class).join(join_class)
-        query = query.filter(join_class.owner == current_user)
+        query = query.filter(join_class.owner_id == current_user.id)
         base_id, join_id = entity_id
         if base_id:
             query = query.filter(base_class.id == base_id)
         if join_id:
             query = query.filter(join_class.id == join_id)
-        entity_list = query.all()
     else:
-        entity_list = entity.query.filter_by(**kwargs).all()
-    return entity_list
+        query = entity.query.filter_by(**kwargs)
+    return query
 
 
 class Login(restful.Resource):
@@ -243,20 +616,28 @@ class Login(restful.Resource):
         parser.add_argument('password', type=str, required=True)
         args = parser.parse_args()
 
-        user = load_user(args['login'])
+        user = get_user(args['login'])
         can_login = False
 
         if ldap_manager:
-            response = ldap_manager.authenticate(args['login'],
-                                                 args['password'])
-            if ars.success == response.status:
-                if not user:
-                    user = User(args['login'], None, None)
-                    db.session.add(user)
-                    db.session.commit()
+            if LDAP_LOGINS.verify(args['login'], args['password']):
                 can_login = True
+            else:
+                try:
+                    response = ldap_manager.authenticate(args['login'],
+                                                         args['password'])
+                except DirectoryBusy:
+                    abort(503)
+                if ars.success == response.status:
+                    LDAP_LOGINS.remember(args['login'], args['password'])
+                    can_login = True
+            if can_login and not user:
+                user = User(args['login'], None, None)
+                db.session.add(user)
+                db.session.commit()
+                USERS.invalidate(user.login)
         elif user:
-            if user.is_correct_password(args['password']):
+            if check_password(user, args['password']):
                 can_login = True
         if can_login:
             login_user(user)
@@ -272,12 +653,20 @@ class ImageBuild(ProtectedResource):
                 return {'error': 'could not find image with id %s' % image_id}
             image = image[0]
 
-        res = build_and_push.AsyncResult(build_id)
-        if res and res.state == 'FAILURE':
-            return {'state': res.state, 'error': 'Docker threw an error',
-                    'output': res.traceback}
-        elif res and res.state == 'SUCCESS':
-            result = res.get()
+        schedule_builds()
+        build = Build.query.filter_by(task_id=build_id).first()
+        if build and build.result:
+            # kept on the build, the result backend may have expired it
+            # and builds served from an identical one never had it
+            state, result = 'SUCCESS', json.loads(build.result)
+        else:
+            res = build_and_push.AsyncResult(build_id)
+            if res and res.state == 'FAILURE':
+                return {'state': res.state, 'error': 'Docker threw an error',
+                        'output': res.traceback}
+            state = res.state
+            result = res.get() if state == 'SUCCESS' else None
+        if state == 'SUCCESS':
             if result.get("error"):
                 return {'state': 'FAILED',
                         'error': result["error"],
@@ -296,11 +685,128 @@ class ImageBuild(ProtectedResource):
                 image.tag = result["tag"]
                 db.session.add(image)
                 db.session.commit()
-            return {'state': res.state,
+            return {'state': state,
                     'id': image.id,
                     'output': result["output"]}
         else:
-            return {'state': res.state}
+            return {'state': state}
+
+
+def remove_build_context(args):
+    if args.get('path') and os.path.isdir(args['path']):
+        shutil.rmtree(args['path'])
+
+
+def finish_build(task_id, state, result=None):
+    values = {'state': state, 'finished_date': datetime.datetime.utcnow()}
+    if result is not None:
+        values['result'] = json.dumps(result)
+    Build.query.filter_by(task_id=task_id, state='building').update(
+        values, synchronize_session=False)
+    db.session.commit()
+
+
+def reap_builds():
+    # builds whose end message never came in, e.g. a dead worker
+    timeout = datetime.timedelta(seconds=app.config['BUILD_TIMEOUT'])
+    now = datetime.datetime.utcnow()
+    for build in Build.query.filter_by(state='building').all():
+        state = build_and_push.AsyncResult(build.task_id).state
+        if state == 'SUCCESS':
+            finish_build(build.task_id, 'done')
+        elif state in ('FAILURE', 'REVOKED'):
+            finish_build(build.task_id, 'failed')
+        elif build.started_date and build.started_date + timeout < now:
+            logger.warning("Build %s timed out" % build.task_id)
+            finish_build(build.task_id, 'failed')
+
+
+def schedule_builds():
+    reap_builds()
+    running = dict(db.session.query(Build.owner_id, db.func.count(Build.id))
+                   .filter(Build.state == 'building')
+                   .group_by(Build.owner_id).all())
+    total = sum(running.values())
+    queued = (db.session.query(Build.id, Build.owner_id, Build.priority)
+              .filter(Build.state == 'queued')
+              .order_by(Build.priority.desc(), Build.id).all())
+    while queued and total < app.config['BUILD_MAX_CONCURRENCY']:
+        # each user's next build, the least busy user goes first so
+        # nobody waits behind someone else's batch; priorities order a
+        # user's own builds and break ties between users
+        candidates = {}
+        for build_id, owner_id, priority in queued:
+            if running.get(owner_id, 0) >= app.config['BUILD_MAX_PER_USER']:
+                continue
+            candidates.setdefault(owner_id, (build_id, owner_id, priority))
+        if not candidates:
+            break
+        build_id, owner_id, _ = min(
+            candidates.values(),
+            key=lambda c: (running.get(c[1], 0), -c[2], c[0]))
+        queued = [build for build in queued if build[0] != build_id]
+        if dispatch_build(build_id, owner_id):
+            running[owner_id] = running.get(owner_id, 0) + 1
+            total += 1
+
+
+def dispatch_build(build_id, owner_id):
+    # claiming the row first keeps concurrent schedulers from sending
+    # the same build twice, and the claim only goes through while the
+    # limits allow it: the counts above may be stale by now
+    if db.engine.dialect.name == 'postgresql':
+        # counts are read from the snapshot of each statement, claims
+        # have to wait for each other to see those committed before
+        db.session.execute(
+            db.text('LOCK TABLE build IN SHARE ROW EXCLUSIVE MODE'))
+    other = aliased(Build)
+    building = db.session.query(db.func.count(other.id)).filter(
+        other.state == 'building')
+    claimed = Build.query.filter(
+        Build.id == build_id, Build.state == 'queued',
+        building.as_scalar() < app.config['BUILD_MAX_CONCURRENCY'],
+        building.filter(other.owner_id == owner_id).as_scalar() <
+        app.config['BUILD_MAX_PER_USER']).update(
+        {'state': 'building', 'started_date': datetime.datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return False
+    build = Build.query.filter_by(id=build_id).one()
+    try:
+        build_and_push.apply_async(args=[json.loads(build.args)],
+                                   task_id=build.task_id,
+                                   queue=app.config['BUILD_QUEUE'])
+    except Exception as error:
+        logger.error("Could not dispatch build %s: %s" %
+                     (build.task_id, error))
+        build.state = 'queued'
+        build.started_date = None
+        db.session.commit()
+        return False
+    return True
+
+
+def on_build_finished(task_id, state, result=None):
+    with app.app_context():
+        finish_build(task_id, state, result)
+        schedule_builds()
+        db.session.remove()
+
+
+def on_schedule_tick():
+    # builds whose worker died and jobs that could not be queued are
+    # picked up again every SCHEDULE_INTERVAL seconds, the publisher's
+    # counters are logged along
+    with app.app_context():
+        try:
+            schedule_builds()
+            retry_waiting_jobs()
+            SENDER.log_stats()
+        except Exception:
+            logger.exception("Scheduling failed")
+        finally:
+            db.session.remove()
 
 
 class Images(ProtectedResource):
@@ -318,9 +824,54 @@ class Images(ProtectedResource):
         return self.process()
 
     def process(self):
-        res = build_and_push.delay(self.parse_request())
-
-        return {'status': 'Your image is being built', 'build_id': res.id}
+        parser = reqparse.RequestParser()
+        parser.add_argument('priority', type=int, default=0)
+        priority = parser.parse_args()['priority']
+        args = self.parse_request()
+        digest = None if args.get('nocache') else context_hash(args)
+        built = None
+        if digest:
+            built = self.same_build(args.get('name'), digest)
+            # the same build is on its way, wait for that one
+            if built and built.state != 'done':
+                remove_build_context(args)
+                return {'status': 'Your image is being built',
+                        'build_id': built.task_id}
+
+        build = Build(args, current_user, priority)
+        build.context_hash = digest
+        if built:
+            # or was built already, hand out the same result
+            build.state = 'done'
+            build.result = built.result
+            build.finished_date = datetime.datetime.utcnow()
+            remove_build_context(args)
+        db.session.add(build)
+        db.session.commit()
+        if build.state == 'queued':
+            schedule_builds()
+
+        return {'status': 'Your image is being built',
+                'build_id': build.task_id}
+
+    def same_build(self, name, digest):
+        # the tag only depends on the user and the name, it holds what the
+        # last build of that name pushed, or what the ones in flight will
+        builds = Build.query.filter(Build.owner_id == current_user.id,
+                                    Build.name == name)
+        pending = (builds.filter(Build.state.in_(('queued', 'building')))
+                   .order_by(Build.id.desc()).all())
+        if pending:
+            if all(build.context_hash == digest for build in pending):
+                return pending[0]
+            return None
+        last = (builds.filter(Build.state == 'done',
+                              Build.finished_date.isnot(None))
+                .order_by(Build.finished_date.desc(), Build.id.desc())
+                .first())
+        if last and last.context_hash == digest and last.result:
+            return last
+        return None
 
     def delete(self, image_id):
         image = get_entities(Image, image_id)
@@ -328,7 +879,7 @@ class Images(ProtectedResource):
             return {'error': ('You either don\'t have the rights to update '
                               'this image, or it does not exist')}
         image = image[0]
-        client = get_docker_client()
+        client = DOCKER.get()
         client.remove_image(image.name)
         db.session.delete(image)
         db.session.commit()
@@ -346,8 +897,7 @@ class Images(ProtectedResource):
 
         path = get_working_dir()
         for filestorage in args['attachments']:
-            with open(os.path.join(path, filestorage.filename), "wb+") as fh:
-                fh.write(filestorage.read())
+            save_upload(filestorage, os.path.join(path, filestorage.filename))
 
         content = args['dockerfile']
         if content:
@@ -418,10 +968,17 @@ class Pipelines(ProtectedResource):
                 for idx, job in enumerate(rearrange_jobs):
                     current_jobs[job].sequence_number = idx
                     db.session.add(current_jobs[job])
+                error = check_dependencies(pl.id)
+                if error:
+                    db.session.rollback()
+                    return {'rearrange_jobs': error}
                 return_dict['rearrange_jobs'] = "Successfully removed jobs"
 
         db.session.add(pl)
         db.session.commit()
+        if args.get('remove_jobs') or args.get('rearrange_jobs'):
+            # what the waiting jobs wait for may have changed
+            release_jobs(pl.id)
         return return_dict
 
     def delete(self, pipeline_id):
@@ -448,11 +1005,14 @@ class Jobs(ProtectedResource):
 
             if not job.state == "done":
                 return {"error": "Job has not finished running, or has failed"}
+            if os.path.exists(job.results_zip):
+                return send_file(job.results_zip, as_attachment=True,
+                                 attachment_filename="results.zip",
+                                 conditional=True)
+            # results unpacked by older versions
             try:
-                z_file = get_folder_as_zip("results", job.results_path)
-                return send_file(z_file,
-                                 as_attachment=True,
-                                 attachment_filename=os.path.basename(z_file))
+                chunks = stream_folder_as_zip(job.results_path, app.config)
+                return send_zip_stream(chunks, "results.zip")
             except Exception:
                 return {"error": "Something went wrong, contact your admin"}
         return prepare_entity_dict([Job, Pipeline], [job_id, pipeline_id])
@@ -464,12 +1024,19 @@ class Jobs(ProtectedResource):
 
         parser.add_argument('attachments', type=FileStorage, location='files',
                             action='append', default=[])
+        parser.add_argument('blobs', type=parse_blob, action='append',
+                            default=[])
+        parser.add_argument('sequence_number', type=int)
+        parser.add_argument('depends_on')
+        parser.add_argument('inputs')
         args = parser.parse_args()
 
+        unknown = unknown_blobs(args['blobs'])
+        if unknown:
+            return {"error": "Unknown blobs: %s" % ", ".join(unknown)}
+
         path = get_working_dir(prefix='kabuto-inbox-')
-        for filestorage in args['attachments']:
-            with open(os.path.join(path, filestorage.filename), "wb+") as fh:
-                fh.write(filestorage.read())
+        store_attachments(path, args)
 
         try:
             pipeline = Pipeline.query.filter_by(id=pipeline_id).one()
@@ -481,9 +1048,15 @@ class Jobs(ProtectedResource):
         except NoResultFound:
             return {"error": "Image not found"}
 
-        job = Job(pipeline, image, path, args['command'])
+        job = Job(pipeline, image, path, args['command'],
+                  args['sequence_number'])
 
         db.session.add(job)
+        db.session.flush()
+        error = self.update_dependencies(job, args)
+        if error:
+            db.session.rollback()
+            return {"error": error}
         db.session.commit()
 
         return {'id': job.id}
@@ -500,12 +1073,21 @@ class Jobs(ProtectedResource):
 
         parser.add_argument('attachments', type=FileStorage, location='files',
                             action='append', default=[])
+        parser.add_argument('blobs', type=parse_blob, action='append',
+                            default=[])
+        parser.add_argument('sequence_number', type=int)
+        parser.add_argument('depends_on')
+        parser.add_argument('inputs')
         args = parser.parse_args()
 
+        unknown = unknown_blobs(args['blobs'])
+        if unknown:
+            return {"error": "Unknown blobs: %s" % ", ".join(unknown)}
+
         path = job.attachments_path
-        for filestorage in args['attachments']:
-            with open(os.path.join(path, filestorage.filename), "wb+") as fh:
-                fh.write(filestorage.read())
+        if args['attachments'] or args['blobs']:
+            BUNDLES.invalidate(path)
+        store_attachments(path, args)
 
         if args.get('image_id'):
             try:
@@ -520,8 +1102,16 @@ class Jobs(ProtectedResource):
             if not command == job.command:
                 job.command = command
 
+        if args.get('sequence_number') is not None:
+            job.sequence_number = args['sequence_number']
+        error = self.update_dependencies(job, args)
+        if error:
+            db.session.rollback()
+            return {"error": error}
+
         db.session.add(job)
         db.session.commit()
+        release_jobs(job.pipeline_id)
 
         return {'id': job.id}
 
@@ -540,10 +1130,109 @@ class Jobs(ProtectedResource):
                 SENDER.broadcast(data, 'kill')
             else:
                 return {'error': "Job didn't update properly, try again later"}
+        pipeline_id = job.pipeline_id
+        folders = [job.attachments_path, upload_folder(job)]
+        BUNDLES.invalidate(job.attachments_path)
         db.session.delete(job)
         db.session.commit()
+        # the inbox holds links to the stored blobs, without it they can
+        # be collected
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        # the jobs waiting for it may be free to go
+        release_jobs(pipeline_id)
         return {'message': 'Successfully deleted job'}
 
+    def update_dependencies(self, job, args):
+        if args.get('depends_on') is not None:
+            jobs = pipeline_jobs(job, args['depends_on'])
+            if jobs is None:
+                return "Dependencies must be other jobs of the same pipeline"
+            job.dependencies = jobs
+        if args.get('inputs') is not None:
+            jobs = pipeline_jobs(job, args['inputs'])
+            if jobs is None:
+                return "Inputs must be other jobs of the same pipeline"
+            job.inputs = jobs
+        return check_dependencies(job.pipeline_id)
+
+
+def parse_blob(value):
+    # "<sha256>:<filename>", a file the server already has
+    digest, _, filename = value.partition(':')
+    filename = os.path.basename(filename)
+    if not filename:
+        raise ValueError("Expected <sha256>:<filename>, got %s" % value)
+    BLOBS.blob_path(digest)
+    return digest, filename
+
+
+def owned_blobs(digests):
+    if not digests:
+        return set()
+    owners = BlobOwner.query.filter(BlobOwner.user_id == current_user.id,
+                                    BlobOwner.digest.in_(digests))
+    return set(owner.digest for owner in owners)
+
+
+def own_blob(digest):
+    if not owned_blobs([digest]):
+        db.session.add(BlobOwner(digest, current_user.id))
+
+
+def unknown_blobs(blobs):
+    # blobs of other users are as unknown as missing ones
+    owned = owned_blobs(set(digest for digest, _ in blobs))
+    return [digest for digest, _ in blobs
+            if not BLOBS.enabled or digest not in owned or
+            not BLOBS.exists(digest)]
+
+
+def store_attachments(path, args):
+    for filestorage in args['attachments']:
+        file_path = os.path.join(path, filestorage.filename)
+        save_upload(filestorage, file_path)
+        if BLOBS.enabled:
+            own_blob(BLOBS.add(file_path))
+    for digest, filename in args['blobs']:
+        BLOBS.link(digest, os.path.join(path, filename))
+
+
+class Blob(ProtectedResource):
+    def get(self, digest):
+        try:
+            if not BLOBS.enabled or not BLOBS.exists(digest):
+                abort(404)
+        except ValueError:
+            abort(404)
+        if not owned_blobs([digest]):
+            abort(404)
+        return {"sha256": digest, "size": BLOBS.size(digest)}
+
+
+class Results(ProtectedResource):
+    def get(self, pipeline_id, job_id, name=None):
+        job = get_entities([Job, Pipeline], [job_id, pipeline_id])
+        if not job:
+            return {'error': ('You either don\'t have the rights to see '
+                              'this job, or it does not exist')}
+        job = job[0]
+        if not job.state == "done" or not os.path.exists(job.results_zip):
+            return {"error": "Job has not finished running, or has failed"}
+        if not name:
+            return {"files": zip_listing(job.results_zip)}
+        try:
+            size, chunks = stream_zip_member(job.results_zip, name,
+                                             app.config['ZIP_CHUNK_SIZE'])
+        except KeyError:
+            abort(404)
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        response = Response(chunks, mimetype=mimetype)
+        response.headers['Content-Length'] = size
+        response.headers['Content-Disposition'] = (
+            'attachment; filename=%s' % os.path.basename(name))
+        return response
+
 
 class KillJob(ProtectedResource):
     def get(self, pipeline_id, job_id):
@@ -563,6 +1252,210 @@ class KillJob(ProtectedResource):
         return {'message': 'Success'}
 
 
+class Uploads(ProtectedResource):
+    # resumable uploads: POST creates a session, PUT ?offset= writes a
+    # chunk, GET tells what was received and POST on the session checks
+    # the sha256 and moves the file into the job's inbox
+    def get_job(self, pipeline_id, job_id):
+        job = get_entities([Job, Pipeline], [job_id, pipeline_id])
+        if not job:
+            abort(404)
+        return job[0]
+
+    def get_session(self, job, upload_id):
+        try:
+            session = UploadSession(upload_folder(job), upload_id)
+        except UploadError:
+            abort(404)
+        if not session.exists:
+            abort(404)
+        return session
+
+    def get(self, pipeline_id, job_id, upload_id):
+        job = self.get_job(pipeline_id, job_id)
+        return self.get_session(job, upload_id).as_dict()
+
+    def post(self, pipeline_id, job_id, upload_id=None):
+        job = self.get_job(pipeline_id, job_id)
+        parser = reqparse.RequestParser()
+        parser.add_argument('sha256', type=str)
+        if upload_id:
+            args = parser.parse_args()
+            session = self.get_session(job, upload_id)
+            BUNDLES.invalidate(job.attachments_path)
+            try:
+                digest = session.finalize(job.attachments_path,
+                                          app.config['UPLOAD_CHUNK_SIZE'],
+                                          args['sha256'])
+            except UploadError as error:
+                return {"error": str(error)}, 400
+            if BLOBS.enabled:
+                file_path = os.path.join(job.attachments_path,
+                                         session.meta['filename'])
+                own_blob(BLOBS.add(file_path, digest))
+                db.session.commit()
+            return {"id": upload_id, "sha256": digest}
+
+        parser.add_argument('filename', type=str, required=True)
+        parser.add_argument('size', type=int, required=True)
+        args = parser.parse_args()
+        try:
+            session = UploadSession.create(upload_folder(job),
+                                           args['filename'], args['size'],
+                                           args['sha256'])
+        except UploadError as error:
+            return {"error": str(error)}, 400
+        return {"id": session.id,
+                "chunk_size": app.config['UPLOAD_CHUNK_SIZE']}
+
+    def put(self, pipeline_id, job_id, upload_id):
+        job = self.get_job(pipeline_id, job_id)
+        session = self.get_session(job, upload_id)
+        parser = reqparse.RequestParser()
+        parser.add_argument('offset', type=int, required=True,
+                            location='args')
+        args = parser.parse_args()
+        try:
+            written = session.write_chunk(args['offset'], request.stream,
+                                          app.config['UPLOAD_CHUNK_SIZE'])
+        except UploadError as error:
+            return {"error": str(error)}, 400
+        return {"offset": args['offset'], "written": written}
+
+    def delete(self, pipeline_id, job_id, upload_id):
+        job = self.get_job(pipeline_id, job_id)
+        self.get_session(job, upload_id).abort()
+        return {"message": "Upload cancelled"}
+
+
+def upload_folder(job):
+    # next to the inbox, on the same filesystem but out of the bundles
+    return "%s.uploads" % job.attachments_path.rstrip(os.sep)
+
+
+def pipeline_graph(pipeline_id):
+    # the state of every job in the pipeline and the ids of the jobs it
+    # waits for, in three queries
+    jobs = db.session.query(Job.id, Job.state, Job.sequence_number).filter(
+        Job.pipeline_id == pipeline_id).all()
+    states = dict((job_id, state) for job_id, state, _ in jobs)
+    explicit, inputs = {}, {}
+    for table, column, links in (
+            (job_dependency, job_dependency.c.depends_on_id, explicit),
+            (job_input, job_input.c.input_id, inputs)):
+        query = db.session.query(table.c.job_id, column)
+        for job_id, depends_on_id in query.filter(
+                table.c.job_id.in_(list(states))):
+            if depends_on_id in states:
+                links.setdefault(job_id, set()).add(depends_on_id)
+    # explicit dependencies replace the sequence order, inputs come on
+    # top of whichever applies
+    dependencies = {}
+    for job_id, _, sequence in jobs:
+        if job_id in explicit:
+            dependencies[job_id] = set(explicit[job_id])
+        else:
+            dependencies[job_id] = set(
+                other for other, _, other_sequence in jobs
+                if (other_sequence or 0) < (sequence or 0))
+        dependencies[job_id].update(inputs.get(job_id, ()))
+    return states, dependencies
+
+
+def has_cycle(dependencies):
+    remaining = dict((job_id, set(deps))
+                     for job_id, deps in dependencies.items())
+    while remaining:
+        free = [job_id for job_id, deps in remaining.items() if not deps]
+        if not free:
+            return True
+        for job_id in free:
+            del remaining[job_id]
+        for deps in remaining.values():
+            deps.difference_update(free)
+    return False
+
+
+def pipeline_jobs(job, value):
+    # "<job_id>,<job_id>,...", other jobs of the same pipeline
+    try:
+        ids = set(int(job_id) for job_id in value.split(",")
+                  if job_id.strip())
+    except ValueError:
+        return None
+    jobs = []
+    if ids:
+        jobs = Job.query.filter(Job.id.in_(list(ids)),
+                                Job.pipeline_id == job.pipeline_id).all()
+    if len(jobs) != len(ids) or job.id in ids:
+        return None
+    return jobs
+
+
+def check_dependencies(pipeline_id):
+    if has_cycle(pipeline_graph(pipeline_id)[1]):
+        return "Jobs of the pipeline would be waiting on each other"
+    return None
+
+
+def release_jobs(pipeline_id):
+    # called whenever a job of the pipeline finishes: waiting jobs whose
+    # dependencies are all done get queued, the ones depending on a job
+    # that did not make it are cancelled
+    states, dependencies = pipeline_graph(pipeline_id)
+    cancelled = []
+    changed = True
+    while changed:
+        changed = False
+        for job_id, deps in dependencies.items():
+            if states[job_id] == 'waiting' and any(
+                    states[dep] in ('failed', 'cancelled') for dep in deps):
+                states[job_id] = 'cancelled'
+                cancelled.append(job_id)
+                changed = True
+    if cancelled:
+        Job.query.filter(Job.id.in_(cancelled), Job.state == 'waiting').update(
+            {'state': 'cancelled'}, synchronize_session=False)
+        db.session.commit()
+        logger.info("Cancelled jobs %s of pipeline %s" %
+                    (cancelled, pipeline_id))
+    dispatch_jobs([job_id for job_id, deps in dependencies.items()
+                   if states[job_id] == 'waiting' and
+                   all(states[dep] == 'done' for dep in deps)])
+
+
+def retry_waiting_jobs():
+    # jobs whose dependencies are done but that could not be queued, or
+    # whose dependencies were changed by another process
+    pipelines = db.session.query(Job.pipeline_id).filter(
+        Job.state == 'waiting', Job.pipeline_id.isnot(None)).distinct()
+    for pipeline_id, in pipelines.all():
+        release_jobs(pipeline_id)
+
+
+def dispatch_jobs(job_ids):
+    # claiming the rows first keeps two jobs finishing at the same time
+    # from queueing the same job twice
+    claimed = []
+    for job_id in job_ids:
+        if Job.query.filter_by(id=job_id, state='waiting').update(
+                {'state': 'in_queue'}, synchronize_session=False):
+            claimed.append(job_id)
+    db.session.commit()
+    if not claimed:
+        return
+    jobs = Job.query.options(joinedload(Job.image)).filter(
+        Job.id.in_(claimed)).all()
+    _, failed = SENDER.send_batch([(job.id, job.serialize())
+                                   for job in jobs])
+    if failed:
+        logger.error("Could not queue jobs %s, they stay waiting until "
+                     "the next retry" % sorted(failed))
+        Job.query.filter(Job.id.in_(list(failed))).update(
+            {'state': 'waiting'}, synchronize_session=False)
+        db.session.commit()
+
+
 class Submitter(ProtectedResource):
     def post(self, pipeline_id):
         try:
@@ -570,15 +1463,29 @@ class Submitter(ProtectedResource):
         except NoResultFound:
             return {"error": "Pipeline not found"}
 
-        jobs = []
-        for job in pipeline.jobs:
-            jobs.append(job)
-            SENDER.send(job.serialize())
-            job.state = "in_queue"
-            db.session.add(job)
-            db.session.commit()
+        # the whole pipeline runs again, only the jobs that do not wait
+        # for others are queued now, the rest as their dependencies finish
+        _, dependencies = pipeline_graph(pipeline.id)
+        jobs = pipeline.jobs.options(joinedload(Job.image)).all()
+        runnable = [job for job in jobs if not dependencies[job.id]]
+        sent, failed = SENDER.send_batch([(job.id, job.serialize())
+                                          for job in runnable])
+        result = dict([(str(jb.id), "in_queue" if jb.id not in failed
+                        else jb.state) for jb in runnable])
+        waiting = [job.id for job in jobs if dependencies[job.id]]
+        result.update((str(job_id), "waiting") for job_id in waiting)
+        if sent:
+            Job.query.filter(Job.id.in_(sent)).update(
+                {"state": "in_queue"}, synchronize_session=False)
+        if waiting:
+            Job.query.filter(Job.id.in_(waiting)).update(
+                {"state": "waiting"}, synchronize_session=False)
+        db.session.commit()
 
-        return dict([(jb.id, jb.state) for jb in jobs])
+        if failed:
+            failed_ids = ", ".join(str(jid) for jid in sorted(failed))
+            result['error'] = "Could not queue jobs: %s" % failed_ids
+        return result
 
 
 class LogWithdrawal(ProtectedResource):
@@ -592,7 +1499,7 @@ class LogWithdrawal(ProtectedResource):
             size = 0
         else:
             size = os.path.getsize(log_path)
-        return {"filename": "job_%s_logs.txt" % job_id,
+        return {"filename": self.log_filename(job_id),
                 "size": size}
 
     def post(self, job_id):
@@ -609,22 +1516,56 @@ class LogWithdrawal(ProtectedResource):
         except NoResultFound:
             return {"error": "Job not found"}
 
+        filename = self.log_filename(job_id)
         if os.path.exists(log_path):
-            with open(log_path, "rb") as fh:
-                try:
-                    if start_byte:
-                        fh.seek(start_byte)
-                    if size:
-                        result = fh.read(size)
-                    else:
-                        result = fh.read()
-                except Exception as e:
-                    return {"error": "Could not read log file %s" % e}
+            try:
+                return self.send_log(log_path, filename, start_byte, size)
+            except Exception as e:
+                return {"error": "Could not read log file %s" % e}
+
+        return send_file(BytesIO(b""), as_attachment=True,
+                         attachment_filename=filename)
+
+    def send_log(self, log_path, filename, start_byte=None, size=None):
+        stat = os.stat(log_path)
+        total = stat.st_size
+        status = 200
+        if start_byte is None and size is None and request.range:
+            byte_range = request.range.range_for_length(total)
+            if byte_range is None:
+                return Response(status=416, headers={
+                    'Content-Range': 'bytes */%s' % total})
+            start, stop = byte_range
+            status = 206
         else:
-            result = b""
-
-        return send_file(BytesIO(result), as_attachment=True,
-                         attachment_filename="job_%s_logs.txt" % job_id)
+            start = min(start_byte or 0, total)
+            stop = min(total, start + (size or app.config['LOG_CHUNK_SIZE']))
+
+        etag = "%s-%s-%s-%s" % (stat.st_ino, total, start, stop)
+        # only the etag tells whether the requested range changed, the
+        # modification time is in whole seconds and covers the whole file
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            fh = open(log_path, "rb")
+            fh.seek(start)
+            # wsgi.file_wrapper lets the server sendfile() straight
+            # from the descriptor when it can
+            data = wrap_file(request.environ, FileSlice(fh, stop - start),
+                             buffer_size=64 * 1024)
+            response = Response(data, status=status, mimetype='text/plain',
+                                direct_passthrough=True)
+            response.content_length = stop - start
+            response.headers['Content-Disposition'] = (
+                'attachment; filename=%s' % filename)
+            if status == 206:
+                response.headers['Content-Range'] = (
+                    'bytes %s-%s/%s' % (start, stop - 1, total))
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.set_etag(etag)
+        response.last_modified = datetime.datetime.utcfromtimestamp(
+            int(stat.st_mtime))
+        return response
 
     def get_log_path(self, job_id):
         job = Job.query.filter_by(id=job_id).one()
@@ -632,6 +1573,104 @@ class LogWithdrawal(ProtectedResource):
                                 "job_%s.log" % job.id)
         return log_path
 
+    def log_filename(self, job_id):
+        return "job_%s_logs.txt" % job_id
+
+
+class BuildLogs(LogWithdrawal):
+    # same reads as the job logs, on what build_and_push published
+    def get(self, build_id):
+        return super(BuildLogs, self).get(build_id)
+
+    def post(self, build_id):
+        return super(BuildLogs, self).post(build_id)
+
+    def get_log_path(self, build_id):
+        return os.path.join(app.config['JOB_LOGS_DIR'],
+                            "build_%s.log" % build_id)
+
+    def log_filename(self, build_id):
+        return "build_%s_logs.txt" % build_id
+
+
+class LogFollower(LogWithdrawal):
+    def get(self, job_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('start_byte', type=int, default=0)
+        args = parser.parse_args()
+        # EventSource sends the id of the last event on reconnect
+        try:
+            offset = int(request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            offset = args['start_byte']
+
+        try:
+            job = Job.query.filter_by(id=job_id).one()
+        except NoResultFound:
+            return {"error": "Job not found"}
+        log_path = os.path.join(app.config['JOB_LOGS_DIR'],
+                                "job_%s.log" % job.id)
+        finished = job.state in FINISHED_STATES
+
+        if not LOG_FOLLOWERS.acquire(blocking=False):
+            abort(503)
+        events = self.follow(log_path, max(offset, 0), finished,
+                             timeout=app.config['LOG_FOLLOW_TIMEOUT'],
+                             poll=app.config['LOG_FOLLOW_POLL'],
+                             chunk_size=app.config['LOG_CHUNK_SIZE'])
+        response = Response(events, mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(LOG_FOLLOWERS.release)
+        return response
+
+    def follow(self, log_path, offset, finished, timeout, poll, chunk_size):
+        notifier = LOG_HANDLER.writer.notifier
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        deadline = time.time() + timeout
+        version = notifier.version(log_path)
+        while True:
+            size = 0
+            if os.path.exists(log_path):
+                size = os.path.getsize(log_path)
+            if size > offset:
+                with open(log_path, "rb") as fh:
+                    fh.seek(offset)
+                    data = fh.read(min(size - offset, chunk_size))
+                offset += len(data)
+                lines = decoder.decode(data).split("\n")
+                yield "id: %s\n%s\n\n" % (offset, "\n".join(
+                    "data: %s" % line for line in lines))
+                continue
+            if finished:
+                yield "event: end\ndata: \n\n"
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # other workers' writes only show up on the next poll
+            new_version = notifier.wait(log_path, version,
+                                        min(poll, remaining))
+            if new_version == version:
+                yield ": keepalive\n\n"
+            version = new_version
+
+
+def input_chunks(job):
+    if not os.path.isdir(job.attachments_path):
+        raise Exception("%s is not a folder" % job.attachments_path)
+    entries = folder_entries(job.attachments_path)
+    archives = []
+    for input_job in sorted(job.inputs, key=lambda j: j.id):
+        prefix = "job_%s/" % input_job.id
+        if os.path.exists(input_job.results_zip):
+            archives.append((prefix, input_job.results_zip))
+        elif os.path.isdir(input_job.results_path):
+            # results unpacked by older versions
+            entries = itertools.chain(entries, prefixed_entries(
+                prefix, folder_entries(input_job.results_path)))
+    return stream_zip(entries, app.config, archives)
+
 
 class Attachment(restful.Resource):
     def get(self, job_id, token, container_id):
@@ -645,16 +1684,23 @@ class Attachment(restful.Resource):
             logging.info(msg % (get_remote_ip(), token))
             abort(404)
         try:
-            zip_file = get_folder_as_zip(token, job.attachments_path)
+            # results of other jobs are read from where they are, a
+            # bundle would be one more copy of them
+            if BUNDLES.enabled and not job.inputs:
+                zip_file, chunks = BUNDLES.open(job.attachments_path)
+            else:
+                chunks = input_chunks(job)
             # We'll assume that the job started running
             # when the attachments are downloaded
             job.state = "running"
             job.container_id = container_id
             db.session.add(job)
             db.session.commit()
-            return send_file(zip_file,
-                             as_attachment=True,
-                             attachment_filename=os.path.basename(zip_file))
+            if chunks is None:
+                return send_file(zip_file,
+                                 as_attachment=True,
+                                 attachment_filename="%s.zip" % token)
+            return send_zip_stream(chunks, "%s.zip" % token)
         except Exception as error:
             return "Something went wrong, contact your admin: %s" % error
 
@@ -679,41 +1725,59 @@ class Attachment(restful.Resource):
         parser.add_argument('io', type=int, required=True)
         args = parser.parse_args()
 
-        zip_dir = os.path.join(job.results_path, '%s.zip' % token)
         if args['results']:
-            with open(zip_dir, "wb+") as fh:
-                fh.write(args['results'].read())
-
-        if os.path.exists(zip_dir):
-            with zipfile.ZipFile(zip_dir) as zf:
-                zf.extractall(job.results_path)
-                os.remove(zip_dir)
+            save_upload(args['results'], job.results_zip)
 
-        job.state = args['state']
+        # the job only reaches its final state once its results are in
+        ingest = bool(args['results'])
+        job.state = 'ingesting' if ingest else args['state']
         job.response = int(args['response'])
         job.used_cpu = args['cpu']
         job.used_memory = args['memory']
         job.used_io = args['io']
         db.session.add(job)
         db.session.commit()
+        if ingest:
+            INGESTER.submit(ingest_results, job.id, args['state'])
+        elif job.state in FINISHED_STATES:
+            release_jobs(job.pipeline_id)
 
+        # the worker is done with its inputs, no need to keep them bundled
+        BUNDLES.invalidate(job.attachments_path)
+        LOG_HANDLER.writer.close(LOG_HANDLER.log_path(job.id))
+        return {"state": job.state}
 
-def zipdir(path, zipf, root_folder):
-    # Still need to find a clean way to write empty folders,
-    # as this is not being done
-    for root, _, files in os.walk(path):
-        for fh in files:
-            file_path = os.path.join(root, fh)
-            zipf.write(file_path, os.path.relpath(file_path, root_folder))
+
+def ingest_results(job_id, state):
+    with app.app_context():
+        try:
+            job = Job.query.filter_by(id=job_id).one()
+            try:
+                files = zip_listing(job.results_zip)
+                logger.info("Job %s posted %s result files" %
+                            (job_id, len(files)))
+            except (OSError, zipfile.BadZipFile) as error:
+                logger.error("Could not read the results of job %s: %s" %
+                             (job_id, error))
+                state = 'failed'
+            job.state = state
+            db.session.commit()
+            release_jobs(job.pipeline_id)
+        except Exception:
+            logger.exception("Could not ingest the results of job %s" %
+                             job_id)
+        finally:
+            db.session.remove()
 
 
 class Register(restful.Resource):
     def get(self, user, token):
-        user = load_user(user)
+        user = get_user(user)
         if user and user.token == token:
             user.active = True
             db.session.add(user)
             db.session.commit()
+            USERS.invalidate(user.login)
             return {"registration": "success"}
         return {"registration": "user or token not found"}
 
@@ -733,24 +1797,59 @@ class Register(restful.Resource):
         user.token = str(uuid.uuid4())
         db.session.add(user)
         db.session.commit()
+        USERS.invalidate(user.login)
 #         send_token(args['email'], user, user.token,
 #                    url_root=request.url_root[:-1])
         return {"status": "success",
                 "token": user.token}
 
 
+class Tokens(ProtectedResource):
+    def get(self):
+        tokens = ApiToken.query.filter_by(user_id=current_user.id)
+        return dict((token.id, {"id": token.id,
+                                "name": token.name,
+                                "creation_date": format_date(
+                                    token.creation_date)})
+                    for token in tokens.order_by(ApiToken.id))
+
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('name', type=str, default='')
+        args = parser.parse_args()
+        api_token = ApiToken(args['name'], current_user.id)
+        token = api_token.generate()
+        db.session.add(api_token)
+        db.session.commit()
+        # the only time the token itself is shown
+        return {"id": api_token.id, "token": token}
+
+    def delete(self, token_id):
+        api_token = ApiToken.query.filter_by(id=token_id,
+                                             user_id=current_user.id).first()
+        if not api_token:
+            return {'error': ('You either don\'t have the rights to revoke '
+                              'this token, or it does not exist')}
+        TOKEN_USERS.invalidate(api_token.digest)
+        db.session.delete(api_token)
+        db.session.commit()
+        return {"message": "Token revoked"}
+
+
 class HelloWorld(ProtectedResource):
     def get(self):
         return {'hello': 'world'}
 
 api.add_resource(HelloWorld, '/')
 api.add_resource(Login, '/login')
+api.add_resource(Tokens, '/tokens', '/tokens/<int:token_id>')
 api.add_resource(Register,
                  '/register',
                  '/register/confirm/<string:user>/<string:token>')
 api.add_resource(Images,
                  '/image',
                  '/image/<string:image_id>')
+api.add_resource(BuildLogs, '/image/build/<string:build_id>/logs')
 api.add_resource(ImageBuild,
                  '/image/build/<string:build_id>',
                  '/image/build/<string:build_id>/<string:image_id>')
@@ -761,8 +1860,15 @@ api.add_resource(Jobs,
                  '/jobs',
                  '/pipeline/<string:pipeline_id>/job',
                  '/pipeline/<string:pipeline_id>/job/<string:job_id>')
+api.add_resource(Results,
+                 '/pipeline/<string:pipeline_id>/job/<string:job_id>/results',
+                 '/pipeline/<string:pipeline_id>/job/<string:job_id>/results/<path:name>')
 api.add_resource(KillJob,
                  '/pipeline/<string:pipeline_id>/job/<string:job_id>/kill')
+api.add_resource(Uploads,
+                 '/pipeline/<string:pipeline_id>/job/<string:job_id>/uploads',
+                 '/pipeline/<string:pipeline_id>/job/<string:job_id>/uploads/<string:upload_id>')
+api.add_resource(Blob, '/blob/<string:digest>')
 api.add_resource(Submitter,
                  '/pipeline/<string:pipeline_id>/submit')
 api.add_resource(Attachment,
@@ -770,12 +1876,44 @@ api.add_resource(Attachment,
                  '/execution/<string:job_id>/results/<string:token>')
 api.add_resource(LogWithdrawal,
                  '/execution/<string:job_id>/logs')
+api.add_resource(LogFollower,
+                 '/execution/<string:job_id>/logs/follow')
+
+
+def create_missing_columns(tables=None):
+    # same for columns added to existing tables, they are all nullable
+    inspector = Inspector.from_engine(db.engine)
+    for table in tables or db.metadata.sorted_tables:
+        existing = set(column['name']
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                app.logger.info("Adding column %s.%s" % (table.name,
+                                                         column.name))
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                                  (table.name, column.name, column_type))
+
+
+def create_missing_indexes():
+    # create_all leaves existing tables alone, so databases created
+    # before an index was declared get it here
+    inspector = Inspector.from_engine(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                app.logger.info("Creating index %s" % index.name)
+                index.create(db.engine)
 
 
 def init_db():
     def create_db(timeout):
         try:
             db.create_all()
+            create_missing_columns()
+            create_missing_indexes()
         except OperationalError as error:
             app.logger.error("Could not connect. Retrying in %ss" % timeout)
             time.sleep(timeout)
@@ -795,8 +1933,14 @@ def init_db():
 
 
 init_db()
+LOG_HANDLER = LogHandler()
+LOG_HANDLER.build_finished = on_build_finished
+LOG_HANDLER.scheduled = on_schedule_tick
+# every process is a competing consumer of the log queue, lines of a job
+# only stay in order with a single api process
 receiver = Receiver('logs', app.config)
-receiver.threaded_listen(LogHandler())
+receiver.slots = app.config['LOG_PREFETCH_COUNT']
+receiver.threaded_listen(LOG_HANDLER)
 if __name__ == '__main__':
     app.run(host=app.config['HOST'],
             port=app.config['PORT'])
@@ -0,0 +1,371 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+
+from utils import logger
+
+
+def folder_digest(folder):
+    # fingerprint the folder from its listing, so we never re-read
+    # multi-GB inputs just to find out nothing changed; the folder and
+    # the inodes keep look-alike folders of other jobs apart
+    if not os.path.isdir(folder):
+        raise Exception("%s is not a folder" % folder)
+    digest = hashlib.sha1()
+    digest.update(os.path.abspath(folder).encode('utf-8') + b"\0")
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            entry = "%s\0%s\0%s\0%s\0%s\n" % (
+                os.path.relpath(file_path, folder), stat.st_size,
+                stat.st_mtime, stat.st_dev, stat.st_ino)
+            digest.update(entry.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def folder_entries(folder):
+    # Still need to find a clean way to write empty folders,
+    # as this is not being done
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            yield os.path.relpath(file_path, folder), file_path
+
+
+class ZipWriter(object):
+    # zip writer for an output that can't seek: every member's crc and
+    # sizes follow its data in a data descriptor, zip64 records are only
+    # written once sizes or offsets outgrow 32 bits; zipfile can only
+    # do this from python 3.6 on
+    ZIP64_LIMIT = 0xFFFFFFFF
+    MAX_ENTRIES = 0xFFFF
+    # what a field holds when its value moved to a zip64 record
+    FULL = 0xFFFFFFFF
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def member(self, arcname, date_time, external_attr, size, chunks,
+               level):
+        # size is only a hint, it picks the zip64 layout up front
+        name = arcname.encode('utf-8')
+        method = 8 if level else 0
+        zip64 = size * 1.05 > self.ZIP64_LIMIT
+        flags = 0x08 | 0x800  # data descriptor, utf-8 name
+        version = 45 if zip64 else 20
+        dos_time, dos_date = dos_date_time(date_time)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        header_offset = self.offset
+        yield self.emit(struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', version, flags, method, dos_time,
+            dos_date, 0, self.FULL if zip64 else 0,
+            self.FULL if zip64 else 0, len(name), len(extra)) +
+            name + extra)
+
+        crc = 0
+        file_size = compress_size = 0
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) \
+            if method else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compress_size += len(chunk)
+                yield self.emit(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            if chunk:
+                yield self.emit(chunk)
+        if not zip64 and max(file_size, compress_size) >= self.ZIP64_LIMIT:
+            raise ValueError("%s is larger than announced" % arcname)
+
+        if zip64:
+            descriptor = struct.pack('<4sLQQ', b'PK\x07\x08', crc,
+                                     compress_size, file_size)
+        else:
+            descriptor = struct.pack('<4s3L', b'PK\x07\x08', crc,
+                                     compress_size, file_size)
+        yield self.emit(descriptor)
+        self.entries.append((name, flags, method, dos_time, dos_date, crc,
+                             compress_size, file_size, external_attr,
+                             header_offset))
+
+    def raw_member(self, arcname, date_time, external_attr, method, crc,
+                   compress_size, file_size, chunks):
+        # chunks are already compressed with method, crc and sizes are known
+        # up front so they go in the local header and need no descriptor
+        name = arcname.encode('utf-8')
+        zip64 = max(file_size, compress_size) >= self.ZIP64_LIMIT
+        flags = 0x800  # utf-8 name
+        version = 45 if zip64 else 20
+        dos_time, dos_date = dos_date_time(date_time)
+        extra = b''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+        header_offset = self.offset
+        yield self.emit(struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', version, flags, method, dos_time,
+            dos_date, crc, self.FULL if zip64 else compress_size,
+            self.FULL if zip64 else file_size, len(name), len(extra)) +
+            name + extra)
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            yield self.emit(chunk)
+        if written != compress_size:
+            raise ValueError("%s is not %d bytes" % (arcname, compress_size))
+        self.entries.append((name, flags, method, dos_time, dos_date, crc,
+                             compress_size, file_size, external_attr,
+                             header_offset))
+
+    def close(self):
+        directory_offset = self.offset
+        for (name, flags, method, dos_time, dos_date, crc, compress_size,
+             file_size, external_attr, header_offset) in self.entries:
+            # the zip64 extra field holds the values that do not fit, in
+            # this order, their own fields are set to FULL
+            values = [file_size, compress_size, header_offset]
+            large = [value for value in values if value >= self.ZIP64_LIMIT]
+            file_size, compress_size, header_offset = [
+                self.FULL if value >= self.ZIP64_LIMIT else value
+                for value in values]
+            extra = b''
+            if large:
+                extra = struct.pack('<HH%dQ' % len(large), 1, 8 * len(large),
+                                    *large)
+            version = 45 if large else 20
+            yield self.emit(struct.pack(
+                '<4s6H3L5H2L', b'PK\x01\x02', version | 3 << 8, version,
+                flags, method, dos_time, dos_date, crc, compress_size,
+                file_size, len(name), len(extra), 0, 0, 0, external_attr,
+                header_offset) + name + extra)
+
+        count = len(self.entries)
+        directory_size = self.offset - directory_offset
+        if count > self.MAX_ENTRIES or \
+                max(directory_offset, directory_size) >= self.ZIP64_LIMIT:
+            end_offset = self.offset
+            yield self.emit(struct.pack(
+                '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count,
+                count, directory_size, directory_offset))
+            yield self.emit(struct.pack('<4sLQL', b'PK\x06\x07', 0,
+                                        end_offset, 1))
+            count = min(count, 0xFFFF)
+            directory_size = min(directory_size, self.FULL)
+            directory_offset = min(directory_offset, self.FULL)
+        yield self.emit(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count,
+                                    count, directory_size, directory_offset,
+                                    0))
+
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (hour << 11 | minute << 5 | second // 2,
+            (year - 1980) << 9 | month << 5 | day)
+
+
+def read_chunks(fh, chunk_size):
+    return iter(lambda: fh.read(chunk_size), b"")
+
+
+def raw_chunks(fh, info, chunk_size):
+    # the member's compressed bytes as they are stored, the local header
+    # is skipped with its own name and extra lengths, which may differ
+    # from the central directory's
+    fh.seek(info.header_offset)
+    header = fh.read(30)
+    if len(header) != 30 or header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile("bad local header for %s" % info.filename)
+    name_length, extra_length = struct.unpack('<2H', header[26:])
+    fh.seek(name_length + extra_length, os.SEEK_CUR)
+    left = info.compress_size
+    while left:
+        chunk = fh.read(min(chunk_size, left))
+        if not chunk:
+            raise zipfile.BadZipFile("%s is truncated" % info.filename)
+        left -= len(chunk)
+        yield chunk
+
+
+def prefixed_entries(prefix, entries):
+    for arcname, file_path in entries:
+        yield prefix + arcname, file_path
+
+
+def stream_folder_as_zip(folder, config):
+    if not os.path.isdir(folder):
+        raise Exception("%s is not a folder" % folder)
+    return stream_zip(folder_entries(folder), config)
+
+
+def stream_zip(entries, config, archives=()):
+    # archives are (prefix, zip path) pairs whose members get added
+    # under prefix, read straight out of the archive without being
+    # extracted anywhere
+    level = config['ZIP_COMPRESSION_LEVEL']
+    store_extensions = tuple(config['ZIP_STORE_EXTENSIONS'])
+    chunk_size = config['ZIP_CHUNK_SIZE']
+    writer = ZipWriter()
+
+    def member_level(arcname):
+        if arcname.lower().endswith(store_extensions):
+            return 0
+        return level
+
+    for arcname, file_path in entries:
+        stat = os.stat(file_path)
+        date_time = time.localtime(stat.st_mtime)
+        with open(file_path, "rb") as src:
+            yield from writer.member(arcname, date_time,
+                                     (stat.st_mode & 0xFFFF) << 16,
+                                     stat.st_size,
+                                     read_chunks(src, chunk_size),
+                                     member_level(arcname))
+    for prefix, path in archives:
+        # members are copied still compressed, with the crc and sizes of
+        # the archive's central directory, nothing is inflated again
+        with zipfile.ZipFile(path) as archive, open(path, "rb") as raw:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                yield from writer.raw_member(
+                    prefix + info.filename, info.date_time,
+                    info.external_attr, info.compress_type, info.CRC,
+                    info.compress_size, info.file_size,
+                    raw_chunks(raw, info, chunk_size))
+    yield from writer.close()
+
+
+def zip_listing(path):
+    # only reads the central directory, nothing gets decompressed
+    with zipfile.ZipFile(path) as zf:
+        return [{"name": info.filename,
+                 "size": info.file_size,
+                 "compressed_size": info.compress_size,
+                 "modified": "%04d-%02d-%02d %02d:%02d:%02d" % info.date_time}
+                for info in zf.infolist() if not info.filename.endswith('/')]
+
+
+def stream_zip_member(path, name, chunk_size):
+    zf = zipfile.ZipFile(path)
+    try:
+        info = zf.getinfo(name)
+    except KeyError:
+        zf.close()
+        raise
+    member = zf.open(info)
+
+    def chunks():
+        try:
+            for chunk in iter(lambda: member.read(chunk_size), b""):
+                yield chunk
+        finally:
+            member.close()
+            zf.close()
+    return info.file_size, chunks()
+
+
+class BundleCache(object):
+    def __init__(self, config):
+        self.config = config
+        self.folder = config['BUNDLE_CACHE_DIR']
+        self.max_size = config['BUNDLE_CACHE_SIZE']
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def bundle_path(self, digest):
+        return os.path.join(self.folder, "%s.zip" % digest)
+
+    def get(self, folder):
+        bundle, chunks = self.open(folder)
+        for _ in chunks or ():
+            pass
+        return bundle
+
+    def open(self, folder):
+        # the bundle's path, with the chunks of a fresh one when it is not
+        # cached yet; they are written to the cache while they are sent, so
+        # the first download does not wait for the whole zip
+        bundle = self.bundle_path(folder_digest(folder))
+        if self.touch(bundle):
+            return bundle, None
+        return bundle, self.tee(stream_folder_as_zip(folder, self.config),
+                                bundle)
+
+    def touch(self, bundle):
+        # touching the bundle keeps the LRU order on disk, so it is
+        # shared between processes
+        with self.lock:
+            try:
+                os.utime(bundle, None)
+                return True
+            except OSError:
+                return False
+
+    def tee(self, chunks, bundle):
+        # only a stream that got to its end is kept, the rename makes the
+        # bundle appear once complete
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        tmp_bundle = "%s.%s.tmp" % (bundle, uuid.uuid4())
+        try:
+            with open(tmp_bundle, "wb") as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    yield chunk
+            os.rename(tmp_bundle, bundle)
+        finally:
+            if os.path.exists(tmp_bundle):
+                os.remove(tmp_bundle)
+        logger.info("Built attachment bundle %s" % bundle)
+        with self.lock:
+            self.evict(keep=bundle)
+
+    def invalidate(self, folder):
+        if not os.path.isdir(folder):
+            return
+        bundle = self.bundle_path(folder_digest(folder))
+        with self.lock:
+            if os.path.exists(bundle):
+                os.remove(bundle)
+
+    def evict(self, keep=None):
+        if not os.path.isdir(self.folder):
+            return
+        bundles = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.zip'):
+                continue
+            path = os.path.join(self.folder, name)
+            stat = os.stat(path)
+            bundles.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in bundles)
+        for _, size, path in sorted(bundles):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            logger.info("Evicted attachment bundle %s" % path)
@@ -0,0 +1,87 @@
+import errno
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+from utils import logger
+
+DIGEST_RE = re.compile('^[0-9a-f]{64}$')
+
+
+def file_digest(path, chunk_size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+    shutil.copyfile(src, dst)
+    return False
+
+
+class BlobStore(object):
+    # content addressed files shared by every job inbox: an attachment
+    # is stored once under its sha256 and hard linked into the inboxes,
+    # a blob no inbox links to anymore has a link count of 1. Linked
+    # files are never written in place, they are unlinked and replaced
+    def __init__(self, config):
+        self.folder = config['BLOB_STORE_DIR']
+        self.chunk_size = config['UPLOAD_CHUNK_SIZE']
+
+    @property
+    def enabled(self):
+        return bool(self.folder)
+
+    def blob_path(self, digest):
+        if not DIGEST_RE.match(digest or ''):
+            raise ValueError("Invalid sha256 %s" % digest)
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.blob_path(digest))
+
+    def add(self, path, digest=None):
+        digest = digest or file_digest(path, self.chunk_size)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            # same content already stored, swap the file for a link
+            link_or_copy(blob, path)
+            return digest
+        folder = os.path.dirname(blob)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp_blob = "%s.%s.tmp" % (blob, uuid.uuid4())
+        link_or_copy(path, tmp_blob)
+        os.rename(tmp_blob, blob)
+        logger.info("Stored blob %s" % digest)
+        return digest
+
+    def link(self, digest, path):
+        link_or_copy(self.blob_path(digest), path)
+
+    def collect(self):
+        removed = 0
+        if not os.path.isdir(self.folder):
+            return removed
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if DIGEST_RE.match(name) and os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+        return removed
@@ -3,6 +3,7 @@
 from argparse import ArgumentParser
 
 from utils import open_channel
+from blobs import BlobStore
 from config import Config
 config_dict = vars(Config)
 
@@ -86,6 +87,12 @@ def info(queue_name):
         info.method.message_count)
     )
 
+@Action()
+def collect_blobs():
+    'Remove the stored blobs no job uses anymore'
+    removed = BlobStore(config_dict).collect()
+    print('Removed %s blobs' % removed)
+
 if __name__ == '__main__':
     action_list = ', '.join(Action.all())
     parser = ArgumentParser(
@@ -1,16 +1,66 @@
+import os
+
+
 class Config(object):
     HOST = '0.0.0.0'
     PORT = 5000
     DEBUG = True
     TESTING = False
     BCRYPT_LOG_ROUNDS = 12
+    BCRYPT_WORKERS = 2  # password checks running at once
+    BCRYPT_QUEUE = 16  # password checks waiting before logins get a 503
     CSRF_ENABLED = True
     SECRET_KEY = 'you-will-never-get-me'
     AMQP_HOSTNAME = 'localhost'
     AMQP_USER = 'kabuto'
     AMQP_PASSWORD = 'kabuto'
+    AMQP_BATCH_SIZE = 100  # messages per publish transaction
     KABUTO_WORKING_DIR = ''
     JOB_LOGS_DIR = '/tmp'
+    USER_CACHE_TTL = 300  # seconds a logged in user is kept in memory
+    TOKEN_CACHE_TTL = 10  # seconds a revoked api token may still work
+    PAGE_SIZE = 100  # entities per page in listings
+    MAX_PAGE_SIZE = 1000
+    LOG_CHUNK_SIZE = 1024 ** 2  # bytes served per log read by default
+    LOG_FOLLOW_TIMEOUT = 60  # seconds before a follower has to reconnect
+    LOG_FOLLOW_POLL = 2  # seconds between checks for other processes' writes
+    LOG_FOLLOW_MAX = 32  # followers at once per process, more get a 503
+    # request threads per process (gunicorn --threads), followers never
+    # take more than half of them
+    WORKER_THREADS = int(os.environ.get('THREADS', 1))
+    LOG_FLUSH_SIZE = 256 * 1024  # bytes
+    LOG_FLUSH_INTERVAL = 0.5  # seconds
+    LOG_MAX_OPEN_FILES = 128
+    LOG_PREFETCH_COUNT = 100
+    BUILD_QUEUE = 'builds'  # celery queue the build workers consume
+    BUILD_MAX_CONCURRENCY = 4  # builds running at once
+    BUILD_MAX_PER_USER = 2  # builds running at once for one user
+    BUILD_TIMEOUT = 2 * 3600  # seconds before a silent build is given up
+    # seconds between retries of builds and jobs that could not be sent
+    SCHEDULE_INTERVAL = 30
+    # mirrors of the repositories images are built from, empty
+    # clones them again for every build
+    REPO_CACHE_DIR = '/tmp/kabuto-repos'
+    REPO_CACHE_SIZE = 20 * 1024 ** 3  # bytes
+    REPO_IDENTIFY_TIMEOUT = 5  # seconds, slower repositories are not shared
+    BUILD_LOG_BATCH = 50  # build output lines per published message
+    BUILD_OUTPUT_TAIL = 20  # output lines kept in the build result
+    BUNDLE_CACHE_DIR = '/tmp/kabuto-bundles'
+    BUNDLE_CACHE_SIZE = 10 * 1024 ** 3  # bytes, 0 streams every download
+    ZIP_COMPRESSION_LEVEL = 6  # 0 stores everything
+    ZIP_STORE_EXTENSIONS = ('.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z',
+                            '.parquet', '.png', '.jpg', '.jpeg', '.gif',
+                            '.mp3', '.mp4')
+    ZIP_CHUNK_SIZE = 1024 ** 2  # bytes
+    MAX_CONTENT_LENGTH = 16 * 1024 ** 3  # bytes per request
+    UPLOAD_CHUNK_SIZE = 1024 ** 2  # bytes
+    # where big uploads are spooled, on the working dir's filesystem
+    # they are linked into place instead of copied
+    UPLOAD_SPOOL_DIR = ''
+    # attachments stored once by sha256 and linked into the inboxes,
+    # empty disables it
+    BLOB_STORE_DIR = '/tmp/kabuto-blobs'
+    INGEST_WORKERS = 4  # threads checking uploaded results
     CELERY_BROKER_URL = 'amqp://%s:%s@%s:5672/celery' % (AMQP_USER,
                                                          AMQP_PASSWORD,
                                                          AMQP_HOSTNAME)
@@ -23,6 +73,10 @@ class Config(object):
     DOCKER_LOGIN = ""
     DOCKER_PASSWORD = ""
     DOCKER_API_VERSION = "1.17"
+    DOCKER_REGISTRY = 'localhost:7900'  # registry host to log in to
+    DOCKER_LOGIN_TTL = 3600  # seconds a registry login is reused
+    DOCKER_NUM_POOLS = 10  # connection pools kept by the client
+    DOCKER_HEALTH_CHECK_INTERVAL = 60  # seconds between pings
     # python -m smtpd -c DebuggingServer -n localhost:2525
     SMTP_SERVER = 'localhost'
     SMTP_PORT = 2525
@@ -39,6 +93,11 @@ class Config(object):
     LDAP_USER_LOGIN_ATTR = 'uid'  # The Attribute you want users to authenticate to LDAP with.
     LDAP_BIND_USER_DN = ''  # The Username to bind to LDAP with
     LDAP_BIND_USER_PASSWORD = ''
+    LDAP_POOL_SIZE = 8  # connections kept open, also logins binding at once
+    LDAP_POOL_TIMEOUT = 10  # seconds a login waits for a connection
+    LDAP_POOL_IDLE = 60  # seconds before an unused connection is dropped
+    LDAP_CACHE_TTL = 300  # seconds a successful login skips the bind, 0 to disable
+    LDAP_STATS_EVERY = 100  # log bind latencies every this many logins
 
     SENTRY_DSN = ''
 
@@ -3,7 +3,7 @@ import pika
 import time
 import json
 import logging
-from threading import Thread
+from threading import Thread, Lock, local
 from utils import logger
 
 MAX_RETRIES = 8
@@ -70,45 +70,187 @@ class Receiver(Base):
             channel.queue_declare(queue=queue_name, durable=True)
             channel.basic_qos(prefetch_count=int(self.slots))
 
+        if handler.tick_interval:
+            def tick():
+                handler.tick()
+                connection.add_timeout(handler.tick_interval, tick)
+            connection.add_timeout(handler.tick_interval, tick)
+
         channel.basic_consume(handler,
                               queue=queue_name)
         channel.start_consuming()
 
 
 class Sender(Base):
+    # Connections are kept open and reused, one per thread since pika's
+    # BlockingConnection is not thread safe
+    def __init__(self, queue_name, config):
+        super(Sender, self).__init__(queue_name, config)
+        self.batch_size = config['AMQP_BATCH_SIZE']
+        self.local = local()
+        self.lock = Lock()
+        self.published = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.publish_time = 0.
+        self.reported = (0, 0)
+
+    def get_channel(self, transactional=False):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or not connection.is_open:
+            if connection is not None:
+                with self.lock:
+                    self.reconnects += 1
+            connection = self.get_connection()
+            self.local.connection = connection
+            self.local.channels = {}
+            self.local.declared = set()
+        # transactional publishes get their own channel, a message sent
+        # on a channel in tx mode is only delivered on tx_commit
+        channel = self.local.channels.get(transactional)
+        if channel is None or not channel.is_open:
+            channel = connection.channel()
+            if transactional:
+                channel.tx_select()
+            self.local.channels[transactional] = channel
+        return channel
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        self.local.channels = {}
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
     @contextmanager
-    def open_channel(self):
-        connection = self.get_connection()
-        channel = connection.channel()
-        yield channel
-        connection.close()
+    def open_channel(self, transactional=False):
+        try:
+            yield self.get_channel(transactional)
+        except (pika.exceptions.AMQPError, OSError):
+            self.close()
+            raise
+
+    def declare(self, channel, queue_name=None, exchange_name=None):
+        key = (queue_name, exchange_name)
+        if key in self.local.declared:
+            return
+        if queue_name:
+            channel.queue_declare(queue=queue_name, durable=True)
+        if exchange_name:
+            channel.exchange_declare(exchange=exchange_name,
+                                     type='fanout')
+        self.local.declared.add(key)
+
+    def publish(self, body, queue_name=None, exchange_name=None,
+                properties=None):
+        start = time.time()
+        # a broken connection is only noticed when we use it,
+        # so give it one more go on a fresh one
+        for attempt in range(2):
+            try:
+                with self.open_channel() as channel:
+                    self.declare(channel, queue_name, exchange_name)
+                    channel.basic_publish(exchange=exchange_name or '',
+                                          routing_key=queue_name or '',
+                                          body=body,
+                                          properties=properties)
+                break
+            except (pika.exceptions.AMQPError, OSError):
+                with self.lock:
+                    self.failures += 1
+                if attempt:
+                    raise
+                logger.error("Lost connection to the broker, reconnecting")
+        with self.lock:
+            self.published += 1
+            self.publish_time += time.time() - start
+
+    def stats(self):
+        with self.lock:
+            rate = 0.
+            if self.publish_time:
+                rate = self.published / self.publish_time
+            return {"published": self.published,
+                    "failures": self.failures,
+                    "reconnects": self.reconnects,
+                    "publish_time": self.publish_time,
+                    "messages_per_second": rate}
+
+    def log_stats(self):
+        # called periodically, quiet while nothing is being published
+        stats = self.stats()
+        counts = (stats["published"], stats["failures"])
+        if counts == self.reported:
+            return
+        self.reported = counts
+        logger.info("AMQP publishes: %(published)s, %(failures)s failed, "
+                    "%(reconnects)s reconnects, %(messages_per_second).1f "
+                    "messages/s" % stats)
+
+    def send_batch(self, messages, queue_name=None):
+        # messages are (key, message) pairs, published in transactions of
+        # batch_size messages so we only wait on the broker once per batch
+        queue_name = queue_name or self.queue_name
+        properties = pika.BasicProperties(delivery_mode=2,)
+        sent, failed = [], {}
+        for idx in range(0, len(messages), self.batch_size):
+            batch = messages[idx:idx + self.batch_size]
+            start = time.time()
+            for attempt in range(2):
+                try:
+                    with self.open_channel(transactional=True) as channel:
+                        self.declare(channel, queue_name)
+                        for _, message in batch:
+                            if not isinstance(message, str):
+                                message = json.dumps(message)
+                            channel.basic_publish(exchange='',
+                                                  routing_key=queue_name,
+                                                  body=message,
+                                                  properties=properties)
+                        channel.tx_commit()
+                    sent.extend(key for key, _ in batch)
+                    with self.lock:
+                        self.published += len(batch)
+                    break
+                except (pika.exceptions.AMQPError, OSError) as error:
+                    # the transaction was not committed, nothing from
+                    # this batch reached the queue so it is safe to retry
+                    with self.lock:
+                        self.failures += 1
+                    if attempt:
+                        for key, _ in batch:
+                            failed[key] = str(error) or repr(error)
+                    else:
+                        logger.error("Could not publish batch, retrying")
+            with self.lock:
+                self.publish_time += time.time() - start
+        logger.info('--- Sent %s messages to channel %s, %s failed.' %
+                    (len(sent), queue_name, len(failed)))
+        return sent, failed
 
     def send(self, message, queue_name=None):
         queue_name = queue_name or self.queue_name
         if not isinstance(message, str):
             message = json.dumps(message)
-        with self.open_channel() as channel:
-            logger.info('--- Sending message to channel %s.' % queue_name)
-            channel.queue_declare(queue=queue_name, durable=True)
-            properties = pika.BasicProperties(delivery_mode=2,)
-            channel.basic_publish(exchange='',
-                                  routing_key=queue_name,
-                                  body=message,
-                                  properties=properties)
+        logger.info('--- Sending message to channel %s.' % queue_name)
+        properties = pika.BasicProperties(delivery_mode=2,)
+        self.publish(message, queue_name=queue_name, properties=properties)
 
     def broadcast(self, message, exchange_name=None):
         if not isinstance(message, str):
             message = json.dumps(message)
         exchange_name = exchange_name or self.queue_name
-        with self.open_channel() as channel:
-            channel.exchange_declare(exchange=exchange_name,
-                                     type='fanout')
-            channel.basic_publish(exchange=exchange_name,
-                                  routing_key='',
-                                  body=message)
+        self.publish(message, exchange_name=exchange_name)
 
 
 class BaseHandler(object):
+    # when set, tick is called every tick_interval seconds from
+    # the consuming thread
+    tick_interval = None
+
     def __call__(self, ch, method, properties, body):
         try:
             recipe = json.loads(body.decode('utf-8'))
@@ -119,3 +261,6 @@ class BaseHandler(object):
 
     def call(self, recipe):
         raise NotImplementedError()
+
+    def tick(self):
+        pass
@@ -0,0 +1,165 @@
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import ldap3
+from flask_ldap3_login import (AuthenticationResponseStatus,
+                                LDAP3LoginManager)
+
+logger = logging.getLogger("kabuto")
+
+
+class DirectoryBusy(Exception):
+    pass
+
+
+class LatencyStats(object):
+    # latencies of the last `window` authentications against the
+    # directory, summed up in the logs every `every` authentications
+    def __init__(self, window=1000, every=100):
+        self.samples = deque(maxlen=window)
+        self.every = every
+        self.count = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, success):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            if not success:
+                self.failures += 1
+            report = self.every and self.count % self.every == 0
+        if report:
+            logger.info("LDAP binds: %(count)s, %(failures)s failed, "
+                        "p50 %(p50).3fs, p99 %(p99).3fs, max %(max).3fs" %
+                        self.summary())
+
+    def percentile(self, samples, fraction):
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count, failures = self.count, self.failures
+        return {"count": count,
+                "failures": failures,
+                "p50": self.percentile(samples, 0.5),
+                "p99": self.percentile(samples, 0.99),
+                "max": samples[-1] if samples else 0.0}
+
+
+class PooledLDAP3LoginManager(LDAP3LoginManager):
+    # keeps LDAP_POOL_SIZE connections open and rebinds them for every
+    # login instead of opening a socket per bind, and lets at most as
+    # many logins talk to the directory at once
+    def init_app(self, app):
+        super(PooledLDAP3LoginManager, self).init_app(app)
+        size = app.config['LDAP_POOL_SIZE']
+        self.pool_timeout = app.config['LDAP_POOL_TIMEOUT']
+        self.idle_timeout = app.config['LDAP_POOL_IDLE']
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = deque(maxlen=size)
+        self.idle_lock = threading.Lock()
+        self.stats = LatencyStats(every=app.config['LDAP_STATS_EVERY'])
+
+    def authenticate(self, username, password):
+        if not self.slots.acquire(timeout=self.pool_timeout):
+            raise DirectoryBusy("No LDAP connection available")
+        start = time.time()
+        response = None
+        try:
+            response = super(PooledLDAP3LoginManager, self).authenticate(
+                username, password)
+            return response
+        finally:
+            self.slots.release()
+            success = bool(response) and \
+                response.status == AuthenticationResponseStatus.success
+            self.stats.add(time.time() - start, success)
+
+    def _make_connection(self, bind_user=None, bind_password=None,
+                         contextualise=True, **kwargs):
+        connection = None
+        if not kwargs:
+            connection = self.checkout()
+        if connection is None:
+            return super(PooledLDAP3LoginManager, self)._make_connection(
+                bind_user, bind_password, contextualise, **kwargs)
+        connection.user = bind_user
+        connection.password = bind_password
+        connection.authentication = ldap3.ANONYMOUS
+        if bind_user:
+            connection.authentication = getattr(
+                ldap3, self.config.get('LDAP_BIND_AUTHENTICATION_TYPE'))
+        if contextualise:
+            self._contextualise_connection(connection)
+        return connection
+
+    def checkout(self):
+        now = time.time()
+        with self.idle_lock:
+            while self.idle:
+                connection, returned = self.idle.pop()
+                if now - returned < self.idle_timeout and \
+                        not connection.closed:
+                    return connection
+                # the server may have dropped it already
+                connection.unbind()
+        return None
+
+    def destroy_connection(self, connection):
+        self._decontextualise_connection(connection)
+        if connection.closed:
+            return
+        with self.idle_lock:
+            if len(self.idle) < self.idle.maxlen:
+                self.idle.append((connection, time.time()))
+                return
+        connection.unbind()
+
+
+class CredentialCache(object):
+    # successful directory logins for LDAP_CACHE_TTL seconds, so a user
+    # logging in again does not cost a bind; only a salted hash of the
+    # password is kept, failed logins are never cached
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def digest(self, salt, password):
+        return hmac.new(salt, password.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def verify(self, login, password):
+        if not self.ttl:
+            return False
+        with self.lock:
+            entry = self.entries.get(login)
+        if not entry or entry[2] < time.time():
+            return False
+        salt, digest, _ = entry
+        return hmac.compare_digest(digest, self.digest(salt, password))
+
+    def remember(self, login, password):
+        if not self.ttl:
+            return
+        salt = os.urandom(16)
+        with self.lock:
+            self.entries[login] = (salt, self.digest(salt, password),
+                                   time.time() + self.ttl)
+
+    def forget(self, login):
+        with self.lock:
+            self.entries.pop(login, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
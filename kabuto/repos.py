@@ -0,0 +1,111 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from hgapi.hgapi import HgException, Repo
+
+from utils import logger
+
+
+def folder_size(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class RepoCache(object):
+    # one bare mirror per repository url, pulled before every build and
+    # exported into the build context, so only new changesets cross the
+    # network; builds of the same url take turns on a file lock
+    def __init__(self, config):
+        self.folder = config['REPO_CACHE_DIR']
+        self.max_size = config['REPO_CACHE_SIZE']
+
+    @property
+    def enabled(self):
+        return bool(self.folder)
+
+    def mirror_path(self, url):
+        return os.path.join(self.folder,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    @contextmanager
+    def locked(self, mirror, blocking=True):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        with open("%s.lock" % mirror, "w") as lock:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(lock, flags)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def checkout(self, url, dest):
+        mirror = self.mirror_path(url)
+        with self.locked(mirror):
+            start = time.time()
+            try:
+                self.update(url, mirror)
+            except HgException as error:
+                # e.g. the repository was recreated at the same url
+                logger.warning("Could not pull %s into its mirror, cloning "
+                               "it again: %s" % (url, error))
+                shutil.rmtree(mirror, ignore_errors=True)
+                self.update(url, mirror)
+            try:
+                self.archive(mirror, "default", dest)
+            except HgException:
+                # no default branch, hg clone would have used tip
+                self.archive(mirror, "tip", dest)
+            with open("%s.size" % mirror, "w") as fh:
+                fh.write(str(folder_size(mirror)))
+            logger.info("Checked out %s from its mirror in %.2fs" %
+                        (url, time.time() - start))
+        self.evict(keep=mirror)
+
+    def update(self, url, mirror):
+        if os.path.isdir(os.path.join(mirror, ".hg")):
+            Repo.command(mirror, None, "pull", "--quiet", url)
+        else:
+            shutil.rmtree(mirror, ignore_errors=True)
+            Repo.command(self.folder, None, "clone", "--quiet",
+                         "--noupdate", url, mirror)
+
+    def archive(self, mirror, revision, dest):
+        Repo.command(mirror, None, "--config", "ui.archivemeta=false",
+                     "archive", "--rev", revision, dest)
+
+    def evict(self, keep=None):
+        # least recently pulled first, the size is noted after each pull
+        mirrors = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.size'):
+                continue
+            mirror = os.path.join(self.folder, name[:-len('.size')])
+            stat = os.stat(os.path.join(self.folder, name))
+            with open(os.path.join(self.folder, name)) as fh:
+                size = int(fh.read() or 0)
+            mirrors.append((stat.st_mtime, size, mirror))
+        total = sum(size for _, size, _ in mirrors)
+        for _, size, mirror in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            if mirror == keep:
+                continue
+            try:
+                with self.locked(mirror, blocking=False):
+                    shutil.rmtree(mirror, ignore_errors=True)
+                    os.remove("%s.size" % mirror)
+            except BlockingIOError:
+                continue
+            total -= size
+            logger.info("Evicted repository mirror %s" % mirror)
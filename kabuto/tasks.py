@@ -1,10 +1,17 @@
+import hashlib
 import shutil
 import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
 from hgapi import hg_clone
 from hgapi.hgapi import HgException
 import docker
 from utils import make_app, get_working_dir
-from connection import BaseHandler
+from connection import BaseHandler, Sender
+from repos import RepoCache
 from celery import Celery
 import json
 import logging
@@ -31,20 +38,191 @@ def make_celery(config=None):
 celery, app = make_celery()
 
 
+class DockerClients(object):
+    # one client per process, its connection pool is reused between
+    # tasks; the registry login happens on the first push and is kept
+    # until DOCKER_LOGIN_TTL runs out or the registry refuses it
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.client = None
+            self.pid = None
+            self.checked_at = 0
+            self.logged_in_at = None
+
+    def connect(self):
+        return docker.Client(base_url=self.config['DOCKER_CLIENT'],
+                             version=self.config['DOCKER_API_VERSION'],
+                             num_pools=self.config['DOCKER_NUM_POOLS'])
+
+    def healthy(self):
+        try:
+            self.client.ping()
+        except Exception as error:
+            logger.warning("Docker daemon not answering, reconnecting: %s" %
+                           error)
+            return False
+        return True
+
+    def get(self):
+        with self.lock:
+            now = time.time()
+            # sockets are not shared with forked workers
+            stale = self.client is None or self.pid != os.getpid()
+            if not stale and now - self.checked_at > \
+                    self.config['DOCKER_HEALTH_CHECK_INTERVAL']:
+                stale = not self.healthy()
+                self.checked_at = now
+            if stale:
+                self.client = self.connect()
+                self.pid = os.getpid()
+                self.checked_at = now
+                self.logged_in_at = None
+            return self.client
+
+    def login(self, force=False):
+        with self.lock:
+            client = self.get()
+            if not self.config['DOCKER_LOGIN']:
+                return client
+            expired = (self.logged_in_at is None or time.time() -
+                       self.logged_in_at > self.config['DOCKER_LOGIN_TTL'])
+            if force or expired:
+                client.login(self.config['DOCKER_LOGIN'],
+                             self.config['DOCKER_PASSWORD'],
+                             registry=self.config['DOCKER_REGISTRY'],
+                             reauth=force)
+                self.logged_in_at = time.time()
+            return client
+
+
+DOCKER = DockerClients(app.config)
+
+
 def get_docker_client():
-    client = docker.Client(base_url=app.config['DOCKER_CLIENT'],
-                           version=app.config['DOCKER_API_VERSION'])
-    if app.config['DOCKER_LOGIN']:
-        client.login(app.config['DOCKER_LOGIN'],
-                     app.config['DOCKER_PASSWORD'],
-                     registry=app.config['DOCKER_REGISTRY'])
-    return client
+    return DOCKER.get()
+
+
+def push_image(tag):
+    insecure = app.config['DOCKER_REGISTRY_INSECURE']
+    output = DOCKER.login().push(repository=tag, insecure_registry=insecure)
+    if app.config['DOCKER_LOGIN'] and 'unauthorized' in str(output).lower():
+        # the registry dropped our token before its TTL, log in again
+        output = DOCKER.login(force=True).push(repository=tag,
+                                               insecure_registry=insecure)
+    return output
+
+
+BUILD_LOGS = Sender('logs', app.config)
+REPOS = RepoCache(app.config)
+
+
+class BuildLog(object):
+    # sends the build output to the logs queue while the build runs,
+    # in batches, so it can be read before the task returns
+    def __init__(self, build_id, sender):
+        self.build_id = build_id
+        self.sender = sender
+        self.lines = []
+        self.sent_at = time.time()
+        self.broken = False
+
+    def write(self, item):
+        if isinstance(item, dict):
+            text = (item.get('stream') or item.get('status') or
+                    item.get('error') or json.dumps(item))
+        else:
+            text = str(item)
+        if not text.endswith('\n'):
+            text += '\n'
+        self.lines.append(text)
+        if (len(self.lines) >= app.config['BUILD_LOG_BATCH'] or
+                time.time() - self.sent_at >= app.config['LOG_FLUSH_INTERVAL']):
+            self.flush()
+
+    def flush(self):
+        if self.lines and self.build_id and not self.broken:
+            try:
+                self.sender.send({"build_id": self.build_id,
+                                  "log_lines": self.lines})
+            except Exception as error:
+                # the build matters more than its live output
+                logger.warning("Could not publish output of build %s: %s" %
+                               (self.build_id, error))
+                self.broken = True
+        self.lines = []
+        self.sent_at = time.time()
+
+    def close(self, state, result=None):
+        # tells the api the build slot is free again, with the result
+        # so identical builds can reuse it
+        self.flush()
+        self.lines = []
+        if self.build_id and not self.broken:
+            try:
+                self.sender.send({"build_id": self.build_id,
+                                  "log_lines": [],
+                                  "finished": state,
+                                  "result": result})
+            except Exception as error:
+                logger.warning("Could not publish end of build %s: %s" %
+                               (self.build_id, error))
+
+
+@celery.task(name='tasks.build_and_push', bind=True)
+def build_and_push(self, args):
+    build_log = BuildLog(self.request.id, BUILD_LOGS)
+    result = None
+    try:
+        result = build_image(args, build_log)
+        return result
+    finally:
+        failed = result is None or bool(result.get("error"))
+        build_log.close("failed" if failed else "done", result)
+
+
+def context_hash(args):
+    # what makes two builds identical: same user and name (they make the
+    # tag), same Dockerfile and context, or same repository revision
+    digest = hashlib.sha256()
+    for key in ("user", "name", "content"):
+        digest.update((args.get(key) or "").encode('utf-8') + b"\0")
+    if args.get("url"):
+        # asked while the image is submitted, a slow server must not hold
+        # the request: without a revision the build just is not shared
+        try:
+            revision = subprocess.check_output(
+                ["hg", "identify", "-i", args["url"]],
+                cwd=tempfile.gettempdir(), stderr=subprocess.DEVNULL,
+                timeout=app.config['REPO_IDENTIFY_TIMEOUT']).decode('utf-8')
+        except (subprocess.SubprocessError, OSError) as error:
+            logger.warning("Could not identify %s: %s" % (args["url"], error))
+            return None
+        digest.update(("%s\0%s\0" % (args["url"], revision.strip()))
+                      .encode('utf-8'))
+    elif args.get("path"):
+        for root, dirs, files in os.walk(args["path"]):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, args["path"])
+                              .encode('utf-8') + b"\0")
+                with open(file_path, "rb") as fh:
+                    for chunk in iter(lambda: fh.read(1024 ** 2), b""):
+                        digest.update(chunk)
+                digest.update(b"\0")
+    return digest.hexdigest()
 
 
-@celery.task(name='tasks.build_and_push')
-def build_and_push(args):
+def build_image(args, build_log):
     error = None
-    output = []
+    # only the tail goes back through the result backend, the whole
+    # output is in the build log
+    output = deque(maxlen=app.config['BUILD_OUTPUT_TAIL'])
     folder = None
 
     client = get_docker_client()
@@ -53,7 +231,10 @@ def build_and_push(args):
     if args["url"]:
         folder = get_working_dir()
         try:
-            hg_clone(args["url"], folder)
+            if REPOS.enabled:
+                REPOS.checkout(args["url"], folder)
+            else:
+                hg_clone(args["url"], folder)
             dockerfile = os.path.join(folder, "Dockerfile")
             if not os.path.exists(dockerfile):
                 error = "Repository has no file named 'Dockerfile'"
@@ -73,12 +254,14 @@ def build_and_push(args):
     result = client.build(tag=tag,
                           **kwargs)
     for line in result:
-        output.append(json.loads(line.decode()))
+        item = json.loads(line.decode())
+        output.append(item)
+        build_log.write(item)
         if "Successfully built" in str(line):
             error = None
+    build_log.flush()
     if not error:
-        client.push(repository=tag,
-                    insecure_registry=app.config['DOCKER_REGISTRY_INSECURE'])
+        push_image(tag)
 
     if folder:
         shutil.rmtree(folder)
@@ -86,15 +269,182 @@ def build_and_push(args):
         shutil.rmtree(args["path"])
 
     return {"name": args["name"], "content": args["content"],
-            "error": error, "output": output, "tag": tag}
+            "error": error, "output": list(output), "tag": tag}
+
+
+class LogNotifier(object):
+    # lets readers sleep until new lines were written to a log
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+
+    def version(self, path):
+        with self.condition:
+            return self.versions.get(path, 0)
+
+    def notify(self, paths):
+        with self.condition:
+            for path in paths:
+                self.versions[path] = self.versions.get(path, 0) + 1
+            self.condition.notify_all()
+
+    def forget(self, path):
+        with self.condition:
+            self.versions.pop(path, None)
+            self.condition.notify_all()
+
+    def wait(self, path, version, timeout):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.versions.get(path, 0) != version, timeout)
+            return self.versions.get(path, 0)
+
+
+class LogWriter(object):
+    # Buffers log lines per file and writes them out in one go, keeping
+    # the most recently used files open in between
+    def __init__(self, max_open_files):
+        self.max_open_files = max_open_files
+        self.handles = OrderedDict()
+        self.buffers = OrderedDict()
+        self.buffered = 0
+        self.oldest = None
+        self.lag = 0.
+        self.lock = threading.RLock()
+        self.notifier = LogNotifier()
+
+    def write(self, path, lines):
+        data = b"".join(bytes(line, 'utf-8') for line in lines)
+        with self.lock:
+            self.buffers.setdefault(path, []).append(data)
+            self.buffered += len(data)
+            if self.oldest is None:
+                self.oldest = time.time()
+
+    def age(self):
+        if self.oldest is None:
+            return 0.
+        return time.time() - self.oldest
+
+    def get_handle(self, path):
+        fh = self.handles.pop(path, None)
+        if fh is None:
+            while len(self.handles) >= self.max_open_files:
+                _, lru = self.handles.popitem(last=False)
+                lru.close()
+            fh = open(path, "ab")
+        self.handles[path] = fh
+        return fh
+
+    def flush(self):
+        with self.lock:
+            paths = list(self.buffers)
+            for path, chunks in self.buffers.items():
+                try:
+                    fh = self.get_handle(path)
+                    fh.write(b"".join(chunks))
+                    fh.flush()
+                except (IOError, OSError) as e:
+                    # the lines are dropped, the other files still
+                    # get theirs
+                    logger.error("Could not write log %s: %s" % (path, e))
+                    self.discard(path)
+            self.lag = self.age()
+            self.reset()
+        self.notifier.notify(paths)
+        return paths
+
+    def reset(self):
+        with self.lock:
+            self.buffers = OrderedDict()
+            self.buffered = 0
+            self.oldest = None
+
+    def discard(self, path):
+        fh = self.handles.pop(path, None)
+        if fh is not None:
+            try:
+                fh.close()
+            except (IOError, OSError):
+                pass
+
+    def close(self, path):
+        with self.lock:
+            self.flush()
+            fh = self.handles.pop(path, None)
+            if fh is not None:
+                fh.close()
+        self.notifier.forget(path)
+
+    def stats(self):
+        with self.lock:
+            return {"lag": self.lag,
+                    "buffered": self.buffered,
+                    "open_files": len(self.handles)}
 
 
 class LogHandler(BaseHandler):
+    def __init__(self):
+        self.writer = LogWriter(app.config['LOG_MAX_OPEN_FILES'])
+        self.tick_interval = app.config['LOG_FLUSH_INTERVAL']
+        self.unacked = 0
+        self.last_delivery = None
+        # called with the build id and its final state when a build ends
+        self.build_finished = None
+        # called every SCHEDULE_INTERVAL seconds
+        self.scheduled = None
+        self.schedule_interval = app.config['SCHEDULE_INTERVAL']
+        self.next_schedule = 0
+
+    def __call__(self, ch, method, properties, body):
+        try:
+            recipe = json.loads(body.decode('utf-8'))
+            self.call(recipe)
+        except Exception as e:
+            logger.critical("Exception: %s" % e)
+        # messages are acked once their lines hit the disk
+        self.unacked += 1
+        self.last_delivery = (ch, method.delivery_tag)
+        if (self.writer.buffered >= app.config['LOG_FLUSH_SIZE'] or
+                self.unacked >= app.config['LOG_PREFETCH_COUNT'] or
+                self.writer.age() >= self.tick_interval):
+            self.flush()
+
+    def tick(self):
+        if self.unacked or self.writer.buffered:
+            self.flush()
+        if self.scheduled and time.time() >= self.next_schedule:
+            self.next_schedule = time.time() + self.schedule_interval
+            self.scheduled()
+
+    def flush(self):
+        try:
+            self.writer.flush()
+        except Exception as e:
+            # keep consuming, whatever could not be written is lost
+            logger.critical("Could not flush logs: %s" % e)
+            self.writer.reset()
+        if self.last_delivery:
+            ch, delivery_tag = self.last_delivery
+            ch.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        self.last_delivery = None
+        self.unacked = 0
+        logger.debug("Flushed logs, ingest lag %.3fs" % self.writer.lag)
+
+    def log_path(self, job_id):
+        return os.path.join(app.config['JOB_LOGS_DIR'],
+                            "job_%s.log" % job_id)
+
+    def build_log_path(self, build_id):
+        return os.path.join(app.config['JOB_LOGS_DIR'],
+                            "build_%s.log" % build_id)
+
     def call(self, recipe):
-        job_id = recipe['job_id']
-        lines = recipe['log_lines']
-        job_path = os.path.join(app.config['JOB_LOGS_DIR'],
-                                "job_%s.log" % job_id)
-        with open(job_path, "ab") as fh:
-            for line in lines:
-                fh.write(bytes(line, 'utf-8'))
+        if 'build_id' in recipe:
+            path = self.build_log_path(recipe['build_id'])
+        else:
+            path = self.log_path(recipe['job_id'])
+        self.writer.write(path, recipe['log_lines'])
+        if recipe.get('finished') and self.build_finished:
+            self.build_finished(recipe['build_id'], recipe['finished'],
+                                recipe.get('result'))
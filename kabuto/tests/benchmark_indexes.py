@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# Lookup latency on the job table with and without the indexes declared
+# on the models. Standalone, runs against a throwaway sqlite database:
+#   python kabuto/tests/benchmark_indexes.py [number of jobs]
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+JOBS_PER_PIPELINE = 10
+USERS = 100
+REPEAT = 200
+
+SCHEMA = '''
+CREATE TABLE pipeline (id INTEGER PRIMARY KEY, name VARCHAR(128),
+                       creation_date DATETIME, owner_id INTEGER);
+CREATE TABLE job (id INTEGER PRIMARY KEY, image_id INTEGER,
+                  pipeline_id INTEGER, command TEXT, state VARCHAR(32),
+                  creation_date DATETIME, attachments_path VARCHAR(128),
+                  attachments_token VARCHAR(36), results_token VARCHAR(36),
+                  results_path VARCHAR(128), sequence_number INTEGER,
+                  container_id VARCHAR(128));
+'''
+
+INDEXES = '''
+CREATE INDEX ix_pipeline_owner_id ON pipeline (owner_id);
+CREATE INDEX ix_job_image_id ON job (image_id);
+CREATE INDEX ix_job_pipeline_id ON job (pipeline_id);
+CREATE INDEX ix_job_state ON job (state);
+CREATE INDEX ix_job_attachments_token ON job (attachments_token);
+CREATE INDEX ix_job_results_token ON job (results_token);
+CREATE INDEX ix_job_pipeline_sequence ON job (pipeline_id, sequence_number);
+'''
+
+STATES = ['done'] * 96 + ['failed'] * 2 + ['ready', 'running']
+
+
+def populate(conn):
+    pipelines = JOBS // JOBS_PER_PIPELINE
+    conn.executemany('INSERT INTO pipeline VALUES (?, ?, ?, ?)',
+                     ((i, 'pipeline', '2016-01-01', i % USERS)
+                      for i in range(1, pipelines + 1)))
+    tokens = []
+
+    def jobs():
+        for i in range(1, JOBS + 1):
+            token = str(uuid.uuid4())
+            if i % (JOBS // REPEAT or 1) == 0:
+                tokens.append((i, token))
+            yield (i, i % 50, (i - 1) // JOBS_PER_PIPELINE + 1, 'echo',
+                   random.choice(STATES), '2016-01-01', '/tmp/in', token,
+                   str(uuid.uuid4()), '/tmp/out', (i - 1) % JOBS_PER_PIPELINE,
+                   None)
+    conn.executemany('INSERT INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                     '?, ?)', jobs())
+    conn.commit()
+    return pipelines, tokens
+
+
+def lookups(pipelines, tokens):
+    pipeline_ids = [random.randint(1, pipelines) for _ in range(REPEAT)]
+    owner_ids = [random.randint(0, USERS - 1) for _ in range(REPEAT)]
+    return [
+        ('jobs of a pipeline',
+         'SELECT id FROM job WHERE pipeline_id = ?',
+         [(p,) for p in pipeline_ids]),
+        ('next job in a pipeline',
+         'SELECT id FROM job WHERE pipeline_id = ? AND sequence_number = ?',
+         [(p, 3) for p in pipeline_ids]),
+        ('job by attachments token',
+         'SELECT id FROM job WHERE attachments_token = ?',
+         [(token,) for _, token in tokens]),
+        ('running jobs',
+         "SELECT count(*) FROM job WHERE state = 'running'",
+         [()] * 10),
+        ('pipelines of a user',
+         'SELECT id FROM pipeline WHERE owner_id = ? ORDER BY id LIMIT 100',
+         [(o,) for o in owner_ids]),
+    ]
+
+
+def measure(conn, queries):
+    results = {}
+    for name, sql, params in queries:
+        start = time.perf_counter()
+        for args in params:
+            conn.execute(sql, args).fetchall()
+        results[name] = (time.perf_counter() - start) / len(params)
+    return results
+
+
+def main():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA)
+        start = time.perf_counter()
+        pipelines, tokens = populate(conn)
+        print("inserted %s jobs in %.1fs" % (JOBS, time.perf_counter() - start))
+        queries = lookups(pipelines, tokens)
+
+        before = measure(conn, queries)
+        start = time.perf_counter()
+        conn.executescript(INDEXES)
+        print("created indexes in %.1fs" % (time.perf_counter() - start))
+        after = measure(conn, queries)
+
+        print("%-28s %14s %14s" % ("lookup", "no index (ms)", "indexed (ms)"))
+        for name, _, _ in queries:
+            print("%-28s %14.3f %14.3f" % (name, before[name] * 1000,
+                                           after[name] * 1000))
+        conn.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 import pytest
-from kabuto.api import app, db, User
+from kabuto.api import app, db, User, DOCKER, USERS, TOKEN_USERS
 from kabuto.tasks import celery
 from kabuto.tests import sample_dockerfile
 from sqlalchemy.orm.exc import NoResultFound
@@ -21,6 +21,12 @@ class MockClient(object):
     def push(self, *args, **kwargs):
         pass
 
+    def ping(self):
+        return "OK"
+
+    def login(self, *args, **kwargs):
+        pass
+
     def remove_image(self, *args, **kwargs):
         pass
 
@@ -66,6 +72,9 @@ def client():
                         "CELERY_EAGER_PROPAGATES_EXCEPTIONS": True,
                         "BROKER_BACKEND": 'memory'})
     db.create_all()
+    DOCKER.reset()
+    USERS.clear()
+    TOKEN_USERS.clear()
     try:
         User.query.filter_by(login='me').one()
     except NoResultFound:
@@ -0,0 +1,148 @@
+from kabuto.api import app
+from kabuto.archives import (BundleCache, folder_digest, stream_folder_as_zip,
+                            stream_zip, ZipWriter)
+from io import BytesIO
+import os
+import pytest
+import shutil
+import tempfile
+import threading
+import zipfile
+from unittest.mock import patch
+
+
+def test_stream_folder_as_zip():
+    folder = tempfile.mkdtemp()
+    os.mkdir(os.path.join(folder, "sub"))
+    with open(os.path.join(folder, "results.txt"), "w") as fh:
+        fh.write("some results " * 1000)
+    with open(os.path.join(folder, "sub", "data.gz"), "wb") as fh:
+        fh.write(os.urandom(1024))
+
+    config = dict(app.config, ZIP_CHUNK_SIZE=100)
+    chunks = list(stream_folder_as_zip(folder, config))
+    assert len(chunks) > 2
+
+    zp = zipfile.ZipFile(BytesIO(b"".join(chunks)))
+    assert zp.testzip() is None
+    infos = dict((zi.filename, zi) for zi in zp.infolist())
+    assert sorted(infos) == ["results.txt", "sub/data.gz"]
+    assert infos["results.txt"].compress_type == zipfile.ZIP_DEFLATED
+    assert infos["sub/data.gz"].compress_type == zipfile.ZIP_STORED
+    assert zp.read("results.txt") == b"some results " * 1000
+
+    config['ZIP_COMPRESSION_LEVEL'] = 0
+    zp = zipfile.ZipFile(BytesIO(b"".join(stream_folder_as_zip(folder,
+                                                               config))))
+    assert zp.getinfo("results.txt").compress_type == zipfile.ZIP_STORED
+    shutil.rmtree(folder)
+
+    with pytest.raises(Exception):
+        stream_folder_as_zip(folder, config)
+
+
+def test_stream_zip64():
+    folder = tempfile.mkdtemp()
+    for name in ("small.txt", "large.txt"):
+        with open(os.path.join(folder, name), "w") as fh:
+            fh.write(name * 1000)
+    # every size and offset past the limit gets a zip64 record
+    with patch.object(ZipWriter, 'ZIP64_LIMIT', 100), \
+            patch.object(ZipWriter, 'MAX_ENTRIES', 1):
+        data = b"".join(stream_folder_as_zip(folder, app.config))
+    assert b"PK\x06\x06" in data
+    zp = zipfile.ZipFile(BytesIO(data))
+    assert zp.testzip() is None
+    assert sorted(zp.namelist()) == ["large.txt", "small.txt"]
+    assert zp.read("large.txt") == b"large.txt" * 1000
+    shutil.rmtree(folder)
+
+
+def test_folder_digest_of_look_alike_folders():
+    folders = [tempfile.mkdtemp() for _ in range(2)]
+    for folder, content in zip(folders, (b"mine", b"your")):
+        path = os.path.join(folder, "data.txt")
+        with open(path, "wb") as fh:
+            fh.write(content)
+        os.utime(path, (1000000000, 1000000000))
+    # same names, sizes and times, still not the same bundle
+    assert folder_digest(folders[0]) != folder_digest(folders[1])
+    assert folder_digest(folders[0]) == folder_digest(folders[0])
+    for folder in folders:
+        shutil.rmtree(folder)
+
+
+def test_bundle_built_without_the_lock(tmpdir):
+    folder = tmpdir.mkdir("inbox")
+    folder.join("data.txt").write("data")
+    cache = BundleCache(dict(app.config,
+                             BUNDLE_CACHE_DIR=str(tmpdir.join("bundles"))))
+    started, release = threading.Event(), threading.Event()
+
+    def slow_zip(folder, config):
+        started.set()
+        release.wait(5)
+        yield from stream_folder_as_zip(folder, config)
+
+    with patch('kabuto.archives.stream_folder_as_zip', slow_zip):
+        builder = threading.Thread(target=cache.get, args=(str(folder),))
+        builder.start()
+        assert started.wait(5)
+        # an unrelated invalidation does not wait for the build
+        other = tmpdir.mkdir("other")
+        done = threading.Event()
+        threading.Thread(target=lambda: (cache.invalidate(str(other)),
+                                         done.set())).start()
+        assert done.wait(1)
+        release.set()
+        builder.join()
+    bundle = cache.get(str(folder))
+    assert zipfile.ZipFile(bundle).read("data.txt") == b"data"
+
+
+def test_archive_members_copied_compressed(tmpdir):
+    results = str(tmpdir.join("results.zip"))
+    with zipfile.ZipFile(results, "w", zipfile.ZIP_DEFLATED) as zp:
+        zp.writestr("out/results.txt", "some results " * 1000)
+        zp.writestr(zipfile.ZipInfo("out/raw.bin"), os.urandom(1024))
+    infos = zipfile.ZipFile(results).infolist()
+
+    # neither the writer nor zipfile get to deflate or inflate anything
+    with patch('zlib.compressobj') as compressobj, \
+            patch('zlib.decompressobj') as decompressobj:
+        data = b"".join(stream_zip([], app.config, [("1/", results)]))
+    assert not compressobj.called and not decompressobj.called
+
+    zp = zipfile.ZipFile(BytesIO(data))
+    assert zp.testzip() is None
+    for info in infos:
+        copied = zp.getinfo("1/" + info.filename)
+        assert (copied.CRC, copied.compress_size, copied.compress_type) == \
+            (info.CRC, info.compress_size, info.compress_type)
+    assert zp.read("1/out/results.txt") == b"some results " * 1000
+
+    with patch.object(ZipWriter, 'ZIP64_LIMIT', 100):
+        data = b"".join(stream_zip([], app.config, [("1/", results)]))
+    zp = zipfile.ZipFile(BytesIO(data))
+    assert zp.testzip() is None
+    assert zp.read("1/out/results.txt") == b"some results " * 1000
+
+
+def test_bundle_written_while_sent(tmpdir):
+    folder = tmpdir.mkdir("inbox")
+    folder.join("data.txt").write("data " * 1000)
+    cache_dir = tmpdir.join("bundles")
+    cache = BundleCache(dict(app.config, BUNDLE_CACHE_DIR=str(cache_dir),
+                             ZIP_CHUNK_SIZE=100, ZIP_COMPRESSION_LEVEL=0))
+
+    # a download that stops half way leaves nothing behind
+    bundle, chunks = cache.open(str(folder))
+    next(chunks)
+    chunks.close()
+    assert cache_dir.listdir() == []
+
+    bundle, chunks = cache.open(str(folder))
+    data = b"".join(chunks)
+    with open(bundle, "rb") as fh:
+        assert fh.read() == data
+    assert cache.open(str(folder)) == (bundle, None)
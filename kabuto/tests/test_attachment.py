@@ -1,7 +1,11 @@
+import kabuto.api
 import kabuto.tests.conftest
-from kabuto.api import db, Job
+from kabuto.api import db, Job, BUNDLES
+from kabuto.archives import folder_digest
+import pytest
 import zipfile
 from io import BytesIO
+from unittest.mock import patch
 import os
 import json
 
@@ -42,6 +46,33 @@ def test_download_attachments(preloaded_client_with_attachments):
     assert "Something went wrong, contact your admin" in rv.data.decode('utf-8')
 
 
+class QueuedIngester(object):
+    # ingestions only run when a test waits for them, in the test's own
+    # thread: the in-memory test database is not visible to others
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, fn, *args):
+        self.pending.append((fn, args))
+
+    def run(self):
+        while self.pending:
+            fn, args = self.pending.pop(0)
+            fn(*args)
+
+
+@pytest.fixture(autouse=True)
+def ingester():
+    queued = QueuedIngester()
+    with patch('kabuto.api.INGESTER', queued):
+        yield queued
+
+
+def wait_for_state(job_id):
+    kabuto.api.INGESTER.run()
+    return Job.query.filter_by(id=job_id).one().state
+
+
 def test_upload_attachments(preloaded_client_with_attachments):
     job = Job.query.all()[0]
     result_path = job.results_path
@@ -57,8 +88,29 @@ def test_upload_attachments(preloaded_client_with_attachments):
     }
     rv = preloaded_client_with_attachments.post(url, data=data)
     assert rv.status_code == 200
-    assert os.path.exists(os.path.join(result_path, "file1.txt"))
-    assert os.path.exists(os.path.join(result_path, "file2.txt"))
+    assert json.loads(rv.data.decode('utf-8'))['state'] == 'ingesting'
+    assert wait_for_state(job.id) == 'done'
+    # kept as posted, not unpacked
+    assert os.listdir(result_path) == ["results.zip"]
+
+    job = Job.query.all()[0]
+    job_url = "/pipeline/%s/job/%s" % (job.pipeline_id, job.id)
+    rv = preloaded_client_with_attachments.get("%s?result" % job_url)
+    with open(os.path.join(ROOT_DIR, "data", "results.zip"), 'rb') as fh:
+        assert rv.data == fh.read()
+
+    rv = preloaded_client_with_attachments.get("%s/results" % job_url)
+    files = json.loads(rv.data.decode('utf-8'))['files']
+    assert sorted(f['name'] for f in files) == ["file1.txt", "file2.txt"]
+
+    with zipfile.ZipFile(os.path.join(ROOT_DIR, "data", "results.zip")) as zf:
+        expected = zf.read("file1.txt")
+    rv = preloaded_client_with_attachments.get("%s/results/file1.txt"
+                                               % job_url)
+    assert rv.data == expected
+    rv = preloaded_client_with_attachments.get("%s/results/nope.txt"
+                                               % job_url)
+    assert rv.status_code == 404
 
     job = Job.query.all()[0]
     url = "/execution/%s/results/%s" % (job.id, "invalid_token")
@@ -73,3 +125,118 @@ def test_upload_attachments(preloaded_client_with_attachments):
     data = json.loads(rv.data.decode('utf-8'))
     assert data.get('error', None)
     assert data['error'] == "Job not found"
+
+
+def test_upload_broken_results(preloaded_client_with_attachments):
+    job = Job.query.all()[-1]
+    url = "/execution/%s/results/%s" % (job.id, job.results_token)
+    data = {'results': (BytesIO(b"not a zip"), 'results.zip'),
+            "state": "done",
+            "response": '0',
+            "cpu": '0',
+            "memory": '0',
+            "io": '0',
+    }
+    rv = preloaded_client_with_attachments.post(url, data=data)
+    assert rv.status_code == 200
+    assert wait_for_state(job.id) == 'failed'
+
+
+def test_attachments_bundle_cache(preloaded_client_with_attachments):
+    client = preloaded_client_with_attachments
+    job = Job.query.all()[-1]
+    job_url = '/pipeline/%s/job/%s' % (job.pipeline_id, job.id)
+    attachments_path = job.attachments_path
+    url = "/execution/%s/attachments/%s/%s" % (job.id,
+                                               job.attachments_token,
+                                               "some_container_id")
+    bundle = BUNDLES.bundle_path(folder_digest(attachments_path))
+    rv = client.get(url)
+    assert rv.status_code == 200
+    # streamed the first time and kept once the download finished
+    assert not os.path.exists(bundle)
+    data = rv.data
+    with open(bundle, "rb") as fh:
+        assert fh.read() == data
+    assert BUNDLES.get(attachments_path) == bundle
+    built_at = os.path.getmtime(bundle)
+    os.utime(bundle, (built_at - 10, built_at - 10))
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert BUNDLES.get(attachments_path) == bundle
+    assert os.path.getmtime(bundle) > built_at - 10
+
+    attachments = [(open(os.path.join(ROOT_DIR, "data", "file1.txt"), "rb"),
+                    'test3.txt')]
+    client.put(job_url, data={'attachments': attachments})
+    assert not os.path.exists(bundle)
+    rv = client.get(url)
+    zp = zipfile.ZipFile(BytesIO(rv.data))
+    assert len(zp.infolist()) == 3
+
+
+def test_attachments_streamed(preloaded_client_with_attachments):
+    job = Job.query.all()[-1]
+    url = "/execution/%s/attachments/%s/%s" % (job.id,
+                                               job.attachments_token,
+                                               "some_container_id")
+    max_size = BUNDLES.max_size
+    BUNDLES.max_size = 0
+    try:
+        rv = preloaded_client_with_attachments.get(url)
+    finally:
+        BUNDLES.max_size = max_size
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/zip'
+    zp = zipfile.ZipFile(BytesIO(rv.data))
+    assert sorted(zp.namelist()) == ["test1.txt", "test2.txt"]
+
+
+def test_results_as_inputs(preloaded_client_with_attachments):
+    client = preloaded_client_with_attachments
+    job = Job.query.all()[-1]
+    url = "/execution/%s/results/%s" % (job.id, job.results_token)
+    data = {'results': (open(os.path.join(ROOT_DIR, "data", "results.zip"),
+                             'rb'),
+                        'results.zip'),
+            "state": "done",
+            "response": '0',
+            "cpu": '0',
+            "memory": '0',
+            "io": '0',
+    }
+    rv = client.post(url, data=data)
+    assert wait_for_state(job.id) == 'done'
+
+    rv = client.post('/pipeline/%s/job' % job.pipeline_id,
+                     data={'image_id': str(job.image_id),
+                           'command': 'ls /inbox/job_%s' % job.id,
+                           'inputs': str(job.id),
+                           'attachments': [(BytesIO(b"own file"),
+                                            'own.txt')]})
+    next_id = json.loads(rv.data.decode('utf-8'))['id']
+    rv = client.get('/pipeline/%s/job/%s' % (job.pipeline_id, next_id))
+    assert json.loads(rv.data.decode('utf-8'))[str(next_id)]['inputs'] == \
+        [job.id]
+
+    next_job = Job.query.filter_by(id=next_id).one()
+    attachments_path = next_job.attachments_path
+    rv = client.get("/execution/%s/attachments/%s/some_container_id" %
+                    (next_id, next_job.attachments_token))
+    assert rv.status_code == 200
+    zp = zipfile.ZipFile(BytesIO(rv.data))
+    prefix = "job_%s/" % job.id
+    assert zp.namelist() == ["own.txt", prefix + "file1.txt",
+                             prefix + "file2.txt"]
+    with zipfile.ZipFile(os.path.join(ROOT_DIR, "data", "results.zip")) as zf:
+        assert zp.read(prefix + "file1.txt") == zf.read("file1.txt")
+    # streamed from the results, not bundled
+    bundle = BUNDLES.bundle_path(folder_digest(attachments_path))
+    assert not os.path.exists(bundle)
+
+    rv = client.post('/pipeline/%s/job' % job.pipeline_id,
+                     data={'image_id': str(job.image_id),
+                           'command': 'echo', 'inputs': '999'})
+    assert json.loads(rv.data.decode('utf-8'))['error'] == \
+        "Inputs must be other jobs of the same pipeline"
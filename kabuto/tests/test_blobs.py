@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import sys
+from io import BytesIO
+from unittest.mock import patch
+import cli
+from kabuto.api import BLOBS, Job, app
+from kabuto.blobs import BlobStore
+from kabuto.tests.conftest import preload
+
+
+def test_attachments_are_deduplicated(authenticated_client):
+    payload = os.urandom(4096)
+    digest = hashlib.sha256(payload).hexdigest()
+    assert authenticated_client.get('/blob/%s' % digest).status_code == 404
+
+    inboxes = []
+    for _ in range(2):
+        _, _, job_id = preload(authenticated_client, {
+            'command': 'echo hello world',
+            'attachments': [(BytesIO(payload), 'reference.bin')]})
+        inboxes.append(Job.query.filter_by(id=job_id).one().attachments_path)
+    stats = [os.stat(os.path.join(inbox, 'reference.bin'))
+             for inbox in inboxes]
+    assert stats[0].st_ino == stats[1].st_ino
+
+    rv = authenticated_client.get('/blob/%s' % digest)
+    assert json.loads(rv.data.decode('utf-8')) == {"sha256": digest,
+                                                   "size": 4096}
+
+    # reusing the blob by hash, nothing uploaded
+    _, _, job_id = preload(authenticated_client, {
+        'command': 'echo hello world',
+        'blobs': '%s:copy.bin' % digest})
+    inbox = Job.query.filter_by(id=job_id).one().attachments_path
+    with open(os.path.join(inbox, 'copy.bin'), 'rb') as fh:
+        assert fh.read() == payload
+
+    job = Job.query.filter_by(id=job_id).one()
+    rv = authenticated_client.put('/pipeline/%s/job/%s' % (job.pipeline_id,
+                                                           job.id),
+                                  data={'blobs': '%s:other.bin' % ('0' * 64)})
+    assert 'Unknown blobs' in json.loads(rv.data.decode('utf-8'))['error']
+
+    # other users can neither see nor link it
+    authenticated_client.post('/login', data={'login': 'me1',
+                                              'password': 'Secret'})
+    assert authenticated_client.get('/blob/%s' % digest).status_code == 404
+    _, pipeline_id, job_id = preload(authenticated_client, {
+        'command': 'echo hello world'})
+    rv = authenticated_client.put('/pipeline/%s/job/%s' % (pipeline_id,
+                                                           job_id),
+                                  data={'blobs': '%s:stolen.bin' % digest})
+    error = json.loads(rv.data.decode('utf-8'))['error']
+    assert error == "Unknown blobs: %s" % digest
+
+
+def test_collect_blobs(tmpdir):
+    store = BlobStore({'BLOB_STORE_DIR': str(tmpdir.join('blobs')),
+                       'UPLOAD_CHUNK_SIZE': 1024})
+    kept = tmpdir.join('kept.txt')
+    kept.write('kept')
+    dropped = tmpdir.join('dropped.txt')
+    dropped.write('dropped')
+    kept_digest = store.add(str(kept))
+    # the inbox file shares its inode with the blob and stays writable
+    assert os.stat(str(kept)).st_mode & stat.S_IWUSR
+    dropped_digest = store.add(str(dropped))
+    dropped.remove()
+
+    assert store.collect() == 1
+    assert store.exists(kept_digest)
+    assert not store.exists(dropped_digest)
+
+
+def test_collect_blobs_command(authenticated_client, capsys):
+    payload = os.urandom(1024)
+    digest = hashlib.sha256(payload).hexdigest()
+    _, pipeline_id, job_id = preload(authenticated_client, {
+        'command': 'echo hello world',
+        'attachments': [(BytesIO(payload), 'collected.bin')]})
+    inbox = Job.query.filter_by(id=job_id).one().attachments_path
+    assert BLOBS.exists(digest)
+
+    rv = authenticated_client.delete('/pipeline/%s/job/%s' % (pipeline_id,
+                                                              job_id))
+    assert rv.status_code == 200
+    assert not os.path.exists(inbox)
+    with patch('cli.config_dict', dict(app.config)):
+        cli.Action.get('collect_blobs').launch()
+    assert capsys.readouterr().out.startswith('Removed ')
+    assert not BLOBS.exists(digest)
+
+    # and the command line loads
+    cli_path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'cli.py')
+    output = subprocess.check_output([sys.executable, cli_path, 'help'])
+    assert b'collect_blobs' in output
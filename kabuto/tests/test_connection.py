@@ -0,0 +1,87 @@
+from kabuto.connection import Sender
+from kabuto.api import app
+from unittest.mock import patch, MagicMock
+import pika
+import pytest
+
+
+@patch('pika.PlainCredentials')
+@patch('pika.ConnectionParameters')
+@patch('pika.BlockingConnection')
+def test_sender_reuses_connection(mbc, mcp, mpc):
+    sender = Sender('jobs', app.config)
+    sender.send({"some": "message"})
+    sender.send("another message")
+    sender.broadcast({"container_id": "1"}, 'kill')
+    sender.broadcast({"container_id": "2"}, 'kill')
+
+    assert mbc.call_count == 1
+    channel = mbc.return_value.channel.return_value
+    assert channel.queue_declare.call_count == 1
+    assert channel.exchange_declare.call_count == 1
+    assert channel.basic_publish.call_count == 4
+    assert sender.stats()["published"] == 4
+
+    # logged on the schedule tick, only when something was published
+    with patch('kabuto.connection.logger') as logger:
+        sender.log_stats()
+        sender.log_stats()
+        sender.send("one more")
+        sender.log_stats()
+    logged = [call[0][0] for call in logger.info.call_args_list
+              if call[0][0].startswith("AMQP publishes")]
+    assert len(logged) == 2
+    assert logged[-1].startswith("AMQP publishes: 5, 0 failed")
+
+
+@patch('pika.PlainCredentials')
+@patch('pika.ConnectionParameters')
+@patch('pika.BlockingConnection')
+def test_sender_reconnects(mbc, mcp, mpc):
+    broken = MagicMock()
+    broken.channel.return_value.basic_publish.side_effect = \
+        pika.exceptions.AMQPConnectionError()
+    healthy = MagicMock()
+    mbc.side_effect = [broken, healthy]
+
+    sender = Sender('jobs', app.config)
+    sender.send("message")
+
+    assert healthy.channel.return_value.basic_publish.call_count == 1
+    assert broken.close.called
+    stats = sender.stats()
+    assert stats["published"] == 1
+    assert stats["failures"] == 1
+
+    failing = MagicMock()
+    failing.channel.return_value.basic_publish.side_effect = \
+        pika.exceptions.AMQPConnectionError()
+    mbc.side_effect = [failing, failing]
+    sender.close()
+    with pytest.raises(pika.exceptions.AMQPError):
+        sender.send("message")
+
+
+@patch('pika.PlainCredentials')
+@patch('pika.ConnectionParameters')
+@patch('pika.BlockingConnection')
+def test_sender_batch(mbc, mcp, mpc):
+    sender = Sender('jobs', app.config)
+    sender.batch_size = 2
+    messages = [(idx, {"execution": idx}) for idx in range(5)]
+    sent, failed = sender.send_batch(messages)
+
+    assert sent == [0, 1, 2, 3, 4]
+    assert not failed
+    channel = mbc.return_value.channel.return_value
+    assert channel.tx_select.call_count == 1
+    assert channel.tx_commit.call_count == 3
+    assert channel.basic_publish.call_count == 5
+
+    channel.tx_commit.side_effect = [None,
+                                     pika.exceptions.AMQPChannelError(),
+                                     pika.exceptions.AMQPChannelError(),
+                                     None]
+    sent, failed = sender.send_batch(messages)
+    assert sent == [0, 1, 4]
+    assert sorted(failed) == [2, 3]
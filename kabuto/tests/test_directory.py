@@ -0,0 +1,94 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+from flask_ldap3_login import AuthenticationResponse
+from flask_ldap3_login import AuthenticationResponseStatus as ars
+
+from kabuto.directory import (CredentialCache, DirectoryBusy, LatencyStats,
+                              PooledLDAP3LoginManager)
+
+
+def make_manager(**config):
+    app = Flask(__name__)
+    app.config.from_object('kabuto.config.TestingConfig')
+    app.config.update(LDAP_HOST='some_host', **config)
+    return PooledLDAP3LoginManager(app)
+
+
+def test_credential_cache():
+    cache = CredentialCache(300)
+    assert not cache.verify('me', 'Secret')
+    cache.remember('me', 'Secret')
+    assert cache.verify('me', 'Secret')
+    assert not cache.verify('me', 'Wrong')
+    assert not cache.verify('me1', 'Secret')
+    # the password itself is not kept
+    assert 'Secret' not in repr(cache.entries)
+    cache.forget('me')
+    assert not cache.verify('me', 'Secret')
+
+    with patch('kabuto.directory.time.time', return_value=0):
+        cache.remember('me', 'Secret')
+    assert not cache.verify('me', 'Secret')
+
+    disabled = CredentialCache(0)
+    disabled.remember('me', 'Secret')
+    assert not disabled.verify('me', 'Secret')
+
+
+def test_latency_stats():
+    stats = LatencyStats(window=10, every=0)
+    for i in range(20):
+        stats.add(i / 10.0, i % 2)
+    summary = stats.summary()
+    assert summary['count'] == 20
+    assert summary['failures'] == 10
+    assert summary['max'] == 1.9
+    assert summary['p50'] == 1.5
+
+
+def test_connections_are_reused():
+    manager = make_manager(LDAP_POOL_SIZE=2)
+    connection = manager._make_connection('uid=me,ou=people', 'Secret',
+                                          contextualise=False)
+    connection.closed = False
+    connection.unbind = MagicMock()
+    manager.destroy_connection(connection)
+    connection.unbind.assert_not_called()
+
+    reused = manager._make_connection('uid=me1,ou=people', 'Other',
+                                      contextualise=False)
+    assert reused is connection
+    assert reused.user == 'uid=me1,ou=people'
+    assert reused.password == 'Other'
+
+    anonymous = manager._make_connection(contextualise=False)
+    assert anonymous is not connection
+    assert anonymous.authentication == 'ANONYMOUS'
+
+
+def test_stale_connections_are_dropped():
+    manager = make_manager(LDAP_POOL_IDLE=0)
+    connection = manager._make_connection('uid=me,ou=people', 'Secret',
+                                          contextualise=False)
+    connection.closed = False
+    connection.unbind = MagicMock()
+    manager.destroy_connection(connection)
+    assert manager._make_connection(contextualise=False) is not connection
+    connection.unbind.assert_called_once_with()
+
+
+def test_authenticate_bounded():
+    manager = make_manager(LDAP_POOL_SIZE=1, LDAP_POOL_TIMEOUT=0.01)
+    success = AuthenticationResponse(status=ars.success)
+    with patch('flask_ldap3_login.LDAP3LoginManager.authenticate',
+               return_value=success):
+        assert manager.authenticate('me', 'Secret') is success
+        assert manager.stats.summary()['count'] == 1
+        assert manager.stats.summary()['failures'] == 0
+
+        manager.slots.acquire()
+        with pytest.raises(DirectoryBusy):
+            manager.authenticate('me', 'Secret')
+        manager.slots.release()
@@ -1,7 +1,8 @@
 from kabuto.tests import sample_dockerfile
 import json
 from unittest.mock import patch
-from kabuto.api import Image
+from kabuto.api import (Image, Build, User, app, db, schedule_builds,
+                        on_build_finished, dispatch_build)
 from kabuto.tests.conftest import (MockClient, ROOT_DIR, poll_for_image_id,
                                    mock_async_result, mock_broken_async_result)
 from flask_restful import reqparse
@@ -196,3 +197,121 @@ def test_get_details(client):
     assert sorted(images[id2].keys()) == sorted(["id", "name", "creation_date",
                                                  "dockerfile"])
 
+
+class PendingResult(object):
+    def __init__(self, build_id):
+        self.state = "PENDING"
+
+
+@patch('tasks.build_and_push.AsyncResult', PendingResult)
+def test_build_scheduler(client):
+    Build.query.filter(Build.state.in_(['queued', 'building'])).update(
+        {'state': 'done'}, synchronize_session=False)
+    me = User.query.filter_by(login='me').one()
+    me1 = User.query.filter_by(login='me1').one()
+    builds = [Build({"n": n}, me) for n in range(4)]
+    builds.append(Build({"n": 4}, me1))
+    builds.append(Build({"n": 5}, me, priority=10))
+    db.session.add_all(builds)
+    db.session.commit()
+    ids = [(build.id, build.task_id) for build in builds]
+    me_id = me.id
+
+    limits = (app.config['BUILD_MAX_CONCURRENCY'],
+              app.config['BUILD_MAX_PER_USER'])
+    app.config['BUILD_MAX_CONCURRENCY'] = 3
+    app.config['BUILD_MAX_PER_USER'] = 2
+    dispatched = []
+
+    def apply_async(args, task_id, queue):
+        dispatched.append((args[0]["n"], queue))
+    try:
+        with patch('tasks.build_and_push.apply_async', apply_async):
+            schedule_builds()
+            # priority first, then me1 before me's second build
+            assert dispatched == [(5, 'builds'), (4, 'builds'),
+                                  (0, 'builds')]
+            schedule_builds()
+            assert len(dispatched) == 3
+            # another scheduler working from stale counts
+            assert not dispatch_build(ids[2][0], me_id)
+            assert len(dispatched) == 3
+
+            on_build_finished(ids[4][1], 'done')
+            # me1 is done but me is already at its limit
+            assert len(dispatched) == 3
+            on_build_finished(ids[5][1], 'failed')
+            assert dispatched[3:] == [(1, 'builds')]
+    finally:
+        app.config['BUILD_MAX_CONCURRENCY'] = limits[0]
+        app.config['BUILD_MAX_PER_USER'] = limits[1]
+    states = [Build.query.filter_by(id=build_id).one().state
+              for build_id, _ in ids]
+    assert states == ['building', 'building', 'queued', 'queued', 'done',
+                      'failed']
+
+
+@patch('tasks.build_and_push.AsyncResult', PendingResult)
+@patch('tasks.build_and_push.apply_async', lambda *args, **kwargs: None)
+def test_identical_builds_are_shared(authenticated_client):
+    Build.query.filter(Build.state.in_(['queued', 'building'])).update(
+        {'state': 'done'}, synchronize_session=False)
+    db.session.commit()
+    data = {'dockerfile': update_file, 'name': 'shared_build'}
+    rv = authenticated_client.post('/image', data=data)
+    build_id = json.loads(rv.data.decode('utf-8'))['build_id']
+    rv = authenticated_client.post('/image', data=data)
+    assert json.loads(rv.data.decode('utf-8'))['build_id'] == build_id
+
+    on_build_finished(build_id, 'done',
+                      {"name": "shared_build", "content": update_file,
+                       "error": None, "output": ["done"], "tag": "a_tag"})
+    rv = authenticated_client.post('/image', data=data)
+    cached_id = json.loads(rv.data.decode('utf-8'))['build_id']
+    assert cached_id != build_id
+    rv = authenticated_client.get('/image/build/%s' % cached_id)
+    data = json.loads(rv.data.decode('utf-8'))
+    assert data['state'] == 'SUCCESS'
+    assert Image.query.filter_by(id=data['id']).one().tag == "a_tag"
+
+    rv = authenticated_client.post('/image', data={'dockerfile': update_file,
+                                                   'name': 'shared_build',
+                                                   'nocache': 'true'})
+    assert json.loads(rv.data.decode('utf-8'))['build_id'] not in (
+        build_id, cached_id)
+
+
+@patch('tasks.build_and_push.AsyncResult', PendingResult)
+@patch('tasks.build_and_push.apply_async', lambda *args, **kwargs: None)
+def test_overwritten_builds_are_not_shared(authenticated_client):
+    Build.query.filter(Build.state.in_(['queued', 'building'])).update(
+        {'state': 'done'}, synchronize_session=False)
+    db.session.commit()
+
+    def build(dockerfile):
+        rv = authenticated_client.post('/image', data={
+            'dockerfile': dockerfile, 'name': 'overwritten'})
+        return json.loads(rv.data.decode('utf-8'))['build_id']
+
+    def finish(build_id, tag):
+        on_build_finished(build_id, 'done',
+                          {"name": "overwritten", "content": "",
+                           "error": None, "output": [], "tag": tag})
+
+    first = build(update_file)
+    finish(first, "first")
+    second = build(sample_dockerfile)
+    # the first build is not shared while the second one is pending
+    third = build(update_file)
+    assert third not in (first, second)
+    finish(second, "second")
+    finish(third, "third")
+    # the last build pushed the tag, that one is shared
+    cached = build(update_file)
+    assert cached != third
+    rv = authenticated_client.get('/image/build/%s' % cached)
+    data = json.loads(rv.data.decode('utf-8'))
+    assert data['state'] == 'SUCCESS'
+    assert Image.query.filter_by(id=data['id']).one().tag == "third"
+    rv = authenticated_client.get('/image/build/%s' % build(sample_dockerfile))
+    assert json.loads(rv.data.decode('utf-8'))['state'] == 'PENDING'
@@ -1,11 +1,13 @@
 from kabuto.tests import sample_dockerfile
 from kabuto.tests.conftest import preload
-from kabuto.api import Job, Image, Pipeline, db, app, SENDER
+from kabuto.api import (Job, Image, Pipeline, db, app, SENDER,
+                        create_missing_indexes, create_missing_columns)
 import json
 import os
 import zipfile
 from io import BytesIO
 from unittest.mock import patch
+from sqlalchemy.engine.reflection import Inspector
 from kabuto.tests.conftest import MockClient, mock_async_result, poll_for_image_id
 
 
@@ -71,9 +73,9 @@ def test_attach_files_post_create_job(authenticated_client):
     assert rv.status_code == 200
     pipeline_id = json.loads(rv.data.decode('utf-8'))['id']
 
-    authenticated_client.post('/pipeline/%s/job' % pipeline_id,
-                              data={'image_id': image_id,
-                                    'command': 'echo hello world'})
+    rv = authenticated_client.post('/pipeline/%s/job' % pipeline_id,
+                                   data={'image_id': image_id,
+                                         'command': 'echo hello world'})
     assert rv.status_code == 200
     job_id = json.loads(rv.data.decode('utf-8'))['id']
 
@@ -271,3 +273,54 @@ def test_kill_job(authenticated_client):
     result = json.loads(rv.data.decode('utf-8'))
     print(result)
     assert result.get('message') == "Success"
+
+
+def test_create_missing_indexes(client):
+    def job_indexes():
+        inspector = Inspector.from_engine(db.engine)
+        return set(index['name'] for index in inspector.get_indexes('job'))
+
+    assert {'ix_job_state', 'ix_job_pipeline_sequence'} <= job_indexes()
+    db.engine.execute('DROP INDEX ix_job_state')
+    db.engine.execute('DROP INDEX ix_job_pipeline_sequence')
+    assert 'ix_job_state' not in job_indexes()
+    create_missing_indexes()
+    assert {'ix_job_state', 'ix_job_pipeline_sequence'} <= job_indexes()
+
+
+def test_create_missing_columns(client):
+    db.engine.execute('CREATE TABLE old_build (id INTEGER PRIMARY KEY)')
+    try:
+        table = db.metadata.tables['build'].tometadata(db.MetaData(),
+                                                       name='old_build')
+        create_missing_columns([table])
+        inspector = Inspector.from_engine(db.engine)
+        columns = [c['name'] for c in inspector.get_columns('old_build')]
+        assert 'context_hash' in columns and 'result' in columns
+    finally:
+        db.engine.execute('DROP TABLE old_build')
+
+
+def test_large_attachment_is_linked(authenticated_client):
+    payload = os.urandom(2 * 1024 ** 2)
+    data = {'command': 'echo hello world',
+            'attachments': [(BytesIO(payload), 'big.bin')]}
+    with patch('os.link', wraps=os.link) as link:
+        _, _, job_id = preload(authenticated_client, data)
+    assert link.called
+    attachments_path = Job.query.filter_by(id=job_id).one().attachments_path
+    with open(os.path.join(attachments_path, 'big.bin'), 'rb') as fh:
+        assert fh.read() == payload
+
+
+def test_upload_size_cap(preloaded_client):
+    job = Job.query.all()[-1]
+    url = '/pipeline/%s/job/%s' % (job.pipeline_id, job.id)
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    try:
+        rv = preloaded_client.put(url, data={
+            'attachments': [(BytesIO(b'x' * 4096), 'too_big.bin')]})
+    finally:
+        app.config['MAX_CONTENT_LENGTH'] = max_length
+    assert rv.status_code == 413
@@ -1,4 +1,5 @@
 import json
+import time
 from unittest.mock import patch
 from flask_ldap3_login import AuthenticationResponse, AuthenticationResponseStatus as ars
 
@@ -57,11 +58,83 @@ def test_register(client):
         assert data['registration'] == "user or token not found"
 
 
+def test_api_tokens(authenticated_client):
+    from kabuto.api import app, ApiToken, db
+    rv = authenticated_client.post('/tokens', data={'name': 'nightly'})
+    assert rv.status_code == 200
+    data = json.loads(rv.data.decode('utf-8'))
+    token_id, token = data['id'], data['token']
+    # only a hash of the token is kept
+    assert ApiToken.query.filter_by(id=token_id).one().digest != token
+
+    rv = authenticated_client.get('/tokens')
+    tokens = json.loads(rv.data.decode('utf-8'))
+    assert tokens[str(token_id)]['name'] == 'nightly'
+    assert 'token' not in tokens[str(token_id)]
+
+    client = app.test_client()
+    headers = {'Authorization': 'Token %s' % token}
+    rv = client.get('/', headers=headers)
+    assert rv.status_code == 200
+    rv = client.get('/', headers={'Authorization': 'Token wrong'})
+    assert rv.status_code == 401
+
+    rv = authenticated_client.delete('/tokens/%s' % token_id)
+    assert rv.status_code == 200
+    rv = client.get('/', headers=headers)
+    assert rv.status_code == 401
+
+    # revoked by another process: accepted until the cache expires
+    data = json.loads(authenticated_client.post('/tokens').data.decode(
+        'utf-8'))
+    headers = {'Authorization': 'Token %s' % data['token']}
+    assert client.get('/', headers=headers).status_code == 200
+    ApiToken.query.filter_by(id=data['id']).delete()
+    db.session.commit()
+    assert client.get('/', headers=headers).status_code == 200
+    expired = time.time() + app.config['TOKEN_CACHE_TTL'] + 1
+    with patch('kabuto.api.time.time', return_value=expired):
+        assert client.get('/', headers=headers).status_code == 401
+
+
+def test_login_password_checks_saturated(client):
+    with patch('kabuto.api.PASSWORD_SLOTS') as slots:
+        slots.acquire.return_value = False
+        rv = client.post('/login', data={'login': 'me',
+                                         'password': 'Secret'})
+        assert rv.status_code == 503
+    rv = client.post('/login', data={'login': 'me',
+                                     'password': 'Secret'})
+    assert rv.status_code == 200
+
+
+def test_user_cache(client):
+    from kabuto.api import USERS, load_user, User, db
+    USERS.clear()
+    user = load_user('me')
+    assert user.login == 'me'
+    assert load_user('me') is user
+    assert load_user('nonexistant') is None
+
+    # cached for its TTL, even when the row changes
+    row = User.query.filter_by(login='me').one()
+    row.source = 'changed'
+    db.session.commit()
+    assert load_user('me').source is None
+    USERS.invalidate('me')
+    assert load_user('me').source == 'changed'
+    row.source = None
+    db.session.commit()
+    USERS.clear()
+
+
 # This test has to be solved way better but requires a refactoring session
 # of the api to be able to get apps initialized in different ways
 class MockLdapManager(object):
+    binds = 0
 
     def authenticate(self, login, pw):
+        self.binds += 1
         if login == "me" and pw == "Secret":
             return AuthenticationResponse(status=ars.success)
         return AuthenticationResponse(status=ars.fail)
@@ -104,3 +177,14 @@ def test_ldap_login():
     rv = ldap_client.post('/login', data={'login': 'nonexistant',
                                           'password': 'Secret'})
     assert rv.status_code == 401
+
+    # the directory is only asked again for other credentials
+    binds = ldap_ldap_manager.binds
+    rv = ldap_client.post('/login', data={'login': 'me',
+                                          'password': 'Secret'})
+    assert rv.status_code == 200
+    assert ldap_ldap_manager.binds == binds
+    rv = ldap_client.post('/login', data={'login': 'me',
+                                          'password': 'Wrong'})
+    assert rv.status_code == 401
+    assert ldap_ldap_manager.binds == binds + 1
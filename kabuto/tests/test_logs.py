@@ -1,7 +1,11 @@
-from kabuto.api import app
+from kabuto.api import app, db, Job, LOG_HANDLER, follower_slots
 from kabuto.tests.conftest import ROOT_DIR
+from threading import BoundedSemaphore, Thread
+from mock import patch
 import os
 import json
+import shutil
+import time
 
 
 def test_logs(preloaded_client):
@@ -25,3 +29,126 @@ Another log line"""
         expected = """log line
 Another log"""
         assert r.data.decode('utf-8') == expected
+
+
+def test_logs_ranges_and_etag(preloaded_client):
+    ac = preloaded_client
+    with app.app_context():
+        app.config["JOB_LOGS_DIR"] = os.path.join(ROOT_DIR, "data")
+        url = "/execution/1/logs"
+
+        r = ac.post(url, headers={"Range": "bytes=5-12"})
+        assert r.status_code == 206
+        assert r.data == b"log line"
+        assert r.headers["Content-Range"] == "bytes 5-12/30"
+
+        r = ac.post(url, headers={"Range": "bytes=100-"})
+        assert r.status_code == 416
+
+        r = ac.post(url, data={"start_byte": 14})
+        assert r.status_code == 200
+        assert r.data == b"Another log line"
+        etag = r.headers["ETag"]
+        assert r.headers["Last-Modified"]
+
+        r = ac.post(url, data={"start_byte": 14},
+                    headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.data == b""
+
+        r = ac.post(url, data={"start_byte": 5},
+                    headers={"If-None-Match": etag})
+        assert r.status_code == 200
+
+        r = ac.post(url, data={"start_byte": 5},
+                    headers={"If-Modified-Since": r.headers["Last-Modified"]})
+        assert r.status_code == 200
+        assert r.data == b"log line\nAnother log line"
+
+        chunk_size = app.config['LOG_CHUNK_SIZE']
+        app.config['LOG_CHUNK_SIZE'] = 4
+        try:
+            r = ac.post(url)
+        finally:
+            app.config['LOG_CHUNK_SIZE'] = chunk_size
+        assert r.data == b"Some"
+
+
+def test_follow_logs(preloaded_client):
+    ac = preloaded_client
+    log_dir = os.path.join(ROOT_DIR, "data", "follow")
+    os.mkdir(log_dir)
+    job = Job.query.all()[-1]
+    job.state = 'running'
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+    log_path = os.path.join(log_dir, "job_%s.log" % job_id)
+    slots = BoundedSemaphore(follower_slots({"LOG_FOLLOW_MAX": 32,
+                                             "WORKER_THREADS": 4}))
+    with app.app_context(), patch.dict(app.config, {
+            "JOB_LOGS_DIR": log_dir, "LOG_FOLLOW_TIMEOUT": 1,
+            "LOG_FOLLOW_POLL": 5}), \
+            patch('kabuto.api.LOG_FOLLOWERS', slots):
+        with open(log_path, "w") as fh:
+            fh.write("first line\n")
+
+        def append():
+            time.sleep(0.2)
+            LOG_HANDLER.writer.write(log_path, ["second line\n"])
+            LOG_HANDLER.writer.flush()
+        Thread(target=append).start()
+
+        start = time.time()
+        r = ac.get("/execution/%s/logs/follow" % job_id)
+        assert r.mimetype == 'text/event-stream'
+        events = r.data.decode('utf-8')
+        assert events.startswith("id: 11\ndata: first line\ndata: \n\n")
+        assert "id: 23\ndata: second line\ndata: \n\n" in events
+        # woken up by the writer rather than by the 5s poll
+        assert time.time() - start < 3
+        r.close()
+
+        job = Job.query.filter_by(id=job_id).one()
+        job.state = 'done'
+        db.session.add(job)
+        db.session.commit()
+        r = ac.get("/execution/%s/logs/follow" % job_id,
+                   headers={"Last-Event-ID": "11"})
+        assert r.data.decode('utf-8') == ("id: 23\ndata: second line\n"
+                                          "data: \n\nevent: end\ndata: \n\n")
+        r.close()
+
+        r = ac.get("/execution/%s/logs/follow?start_byte=11" % job_id,
+                   headers={"Last-Event-ID": "garbage"})
+        assert r.status_code == 200
+        assert r.data.decode('utf-8').startswith("id: 23\n")
+        r.close()
+
+        # two of the four threads follow, the third follower is refused
+        url = "/execution/%s/logs/follow" % job_id
+        followers = [ac.get(url, buffered=False) for _ in range(2)]
+        assert [r.status_code for r in followers] == [200, 200]
+        assert ac.get(url).status_code == 503
+        followers.pop().close()
+        r = ac.get(url)
+        assert r.status_code == 200
+        r.close()
+        followers.pop().close()
+        assert slots.acquire(blocking=False) and slots.acquire(blocking=False)
+
+    assert follower_slots({"LOG_FOLLOW_MAX": 32, "WORKER_THREADS": 1}) == 0
+    LOG_HANDLER.writer.close(log_path)
+    shutil.rmtree(log_dir)
+
+
+def test_build_logs(authenticated_client, tmpdir):
+    app.config["JOB_LOGS_DIR"] = str(tmpdir)
+    tmpdir.join("build_some_build.log").write("Step 1\nSuccessfully built\n")
+
+    url = "/image/build/some_build/logs"
+    data = json.loads(authenticated_client.get(url).data.decode('utf-8'))
+    assert data == {"filename": "build_some_build_logs.txt", "size": 26}
+
+    r = authenticated_client.post(url, data={"start_byte": 7})
+    assert r.data.decode('utf-8') == "Successfully built\n"
@@ -1,7 +1,9 @@
 import json
 from kabuto.tests.conftest import preload
-from kabuto.api import Pipeline, User, Image, Job, db, app
+from kabuto.api import (Pipeline, User, Image, Job, db, app, pipeline_graph,
+                        on_schedule_tick)
 from unittest.mock import patch
+from sqlalchemy import event
 
 
 def test_create_pipeline(authenticated_client):
@@ -109,6 +111,19 @@ def test_submit_pipeline(mpc, mcp, mbc, mbp, client):
 
     submit_id = list(json.loads(rv.data.decode('utf-8')))[0]
     assert submit_id is not None
+    assert Job.query.filter_by(id=submit_id).one().state == 'in_queue'
+
+    _, pid2, jid2 = preload(client, {'command': 'echo hello world'})
+    # the debug json output sorts keys, which needs them all to be strings
+    with patch('kabuto.api.SENDER.send_batch',
+               return_value=([], {int(jid2): 'broker down'})), \
+            patch.dict(app.config, RESTFUL_JSON={'sort_keys': True}):
+        rv = client.post('/pipeline/%s/submit' % pid2)
+    assert rv.status_code == 200
+    data = json.loads(rv.data.decode('utf-8'))
+    assert data[str(jid2)] == 'ready'
+    assert data['error'] == "Could not queue jobs: %s" % jid2
+    assert Job.query.filter_by(id=jid2).one().state == 'ready'
 
     rv = client.post('/pipeline/%s/submit' % 999)
     data = json.loads(rv.data.decode('utf-8'))
@@ -135,3 +150,193 @@ def test_get_details(client):
     assert not pipe.get(str(pid1))
     assert pipe.get(str(pid2))
     assert pipe[str(pid2)]["jobs"] == [{"id": jid2}]
+
+
+def test_list_pipelines_query_count(authenticated_client):
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def list_pipelines():
+        del statements[:]
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            rv = authenticated_client.get('/pipeline')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return json.loads(rv.data.decode('utf-8')), len(statements)
+
+    list_pipelines()  # the logged in user gets cached
+    _, before = list_pipelines()
+
+    with app.app_context():
+        u = User.query.filter_by(login='me').first()
+        image = Image.query.all()[0]
+        for idx in range(3):
+            pipeline = Pipeline("pipeline %s" % idx, u)
+            db.session.add(pipeline)
+            db.session.add(Job(pipeline, image, "", ""))
+            db.session.add(Job(pipeline, image, "", ""))
+        db.session.commit()
+        pipeline_id = pipeline.id
+        job_ids = sorted(j.id for j in pipeline.jobs)
+
+    pipelines, after = list_pipelines()
+    assert after == before
+    assert pipelines[str(pipeline_id)]["jobs"] == [{"id": jid}
+                                                   for jid in job_ids]
+
+
+def test_list_pipelines_paged(authenticated_client):
+    u = User.query.filter_by(login='me').first()
+    ids = []
+    for i in range(5):
+        pipeline = Pipeline("paged pipeline %s" % i, u)
+        db.session.add(pipeline)
+        db.session.commit()
+        ids.append(pipeline.id)
+
+    rv = authenticated_client.get('/pipeline?after=%s&limit=2' % (ids[0] - 1))
+    assert rv.status_code == 200
+    data = json.loads(rv.data.decode('utf-8'))
+    assert sorted(int(key) for key in data) == ids[:2]
+    assert rv.headers['X-Next-Cursor'] == str(ids[1])
+
+    rv = authenticated_client.get('/pipeline?after=%s&limit=2&fields=name'
+                                  % rv.headers['X-Next-Cursor'])
+    data = json.loads(rv.data.decode('utf-8'))
+    assert sorted(int(key) for key in data) == ids[2:4]
+    assert data[str(ids[2])] == {"id": ids[2], "name": "paged pipeline 2"}
+
+    rv = authenticated_client.get('/pipeline?after=%s' % ids[3])
+    data = json.loads(rv.data.decode('utf-8'))
+    assert [int(key) for key in data] == ids[4:]
+    assert 'X-Next-Cursor' not in rv.headers
+
+    rv = authenticated_client.get('/pipeline?created_before=2000-01-01')
+    assert json.loads(rv.data.decode('utf-8')) == {}
+    rv = authenticated_client.get('/pipeline?created_after=yesterday')
+    assert rv.status_code == 400
+
+
+def test_submit_pipeline_dependencies(authenticated_client):
+    client = authenticated_client
+    image_id, pipeline_id, first = preload(client, {'command': 'echo 1'})
+    url = '/pipeline/%s/job' % pipeline_id
+
+    def add_job(**data):
+        data.update({'image_id': str(image_id), 'command': 'echo'})
+        rv = client.post(url, data=data)
+        return json.loads(rv.data.decode('utf-8'))
+
+    # two branches after the first job, the last one waits for all
+    left = add_job(depends_on=str(first))['id']
+    right = add_job(depends_on=str(first))['id']
+    last = add_job()['id']
+
+    rv = client.get('%s/%s' % (url, left))
+    job = json.loads(rv.data.decode('utf-8'))[str(left)]
+    assert job['depends_on'] == [first]
+
+    error = add_job(depends_on="999")['error']
+    assert error == "Dependencies must be other jobs of the same pipeline"
+    rv = client.put('%s/%s' % (url, first), data={'depends_on': str(last)})
+    error = json.loads(rv.data.decode('utf-8'))['error']
+    assert error == "Jobs of the pipeline would be waiting on each other"
+
+    def states():
+        db.session.expire_all()
+        return dict((job_id, Job.query.filter_by(id=job_id).one().state)
+                    for job_id in (first, left, right, last))
+
+    def finish(job_id, state):
+        job = Job.query.filter_by(id=job_id).one()
+        rv = client.post('/execution/%s/results/%s' % (job_id,
+                                                       job.results_token),
+                         data={'state': state, 'response': '0', 'cpu': '0',
+                               'memory': '0', 'io': '0'})
+        assert rv.status_code == 200
+
+    def send_batch(messages, queue_name=None):
+        queued.extend(key for key, _ in messages)
+        return [key for key, _ in messages], {}
+
+    queued = []
+    with patch('kabuto.api.SENDER.send_batch', side_effect=send_batch):
+        rv = client.post('/pipeline/%s/submit' % pipeline_id)
+        data = json.loads(rv.data.decode('utf-8'))
+        assert data[str(first)] == 'in_queue'
+        assert data[str(last)] == 'waiting'
+        assert queued == [first]
+
+        finish(first, 'done')
+        assert sorted(queued) == sorted([first, left, right])
+        assert states()[last] == 'waiting'
+
+        finish(left, 'done')
+        finish(right, 'failed')
+        assert states()[last] == 'cancelled'
+        assert last not in queued
+
+        # submitting again runs everything again, in order
+        del queued[:]
+        client.post('/pipeline/%s/submit' % pipeline_id)
+        assert queued == [first]
+        assert states()[last] == 'waiting'
+
+
+def test_waiting_jobs_are_released(authenticated_client):
+    client = authenticated_client
+    image_id, pipeline_id, first = preload(client, {'command': 'echo 1'})
+    url = '/pipeline/%s/job' % pipeline_id
+
+    def add_job(**data):
+        data.update({'image_id': str(image_id), 'command': 'echo'})
+        rv = client.post(url, data=data)
+        return json.loads(rv.data.decode('utf-8'))['id']
+
+    second = add_job()
+    third = add_job(inputs=str(first))
+    # inputs come on top of the sequence order
+    assert pipeline_graph(pipeline_id)[1][third] == set([first, second])
+
+    def state(job_id):
+        db.session.expire_all()
+        return Job.query.filter_by(id=job_id).one().state
+
+    def set_state(job_id, value):
+        Job.query.filter_by(id=job_id).update({'state': value})
+        db.session.commit()
+
+    def send_batch(messages, queue_name=None):
+        return [key for key, _ in messages], {}
+
+    with patch('kabuto.api.SENDER.send_batch', side_effect=send_batch):
+        client.post('/pipeline/%s/submit' % pipeline_id)
+        assert state(second) == 'waiting'
+        set_state(first, 'running')
+
+        # the second job no longer waits once it comes first
+        client.put('/pipeline/%s' % pipeline_id,
+                   data={'rearrange_jobs': '%s,%s,%s' % (second, first,
+                                                         third)})
+        assert state(second) == 'in_queue'
+        assert state(third) == 'waiting'
+
+        set_state(second, 'done')
+        with patch('kabuto.api.SENDER.broadcast'):
+            Job.query.filter_by(id=first).update({'container_id': 'abc'})
+            db.session.commit()
+            client.delete('%s/%s' % (url, first))
+        assert state(third) == 'in_queue'
+
+    # a job that could not be sent is retried on the next tick
+    set_state(third, 'waiting')
+    with patch('kabuto.api.SENDER.send_batch',
+               return_value=([], {third: 'broker down'})):
+        on_schedule_tick()
+    assert state(third) == 'waiting'
+    with patch('kabuto.api.SENDER.send_batch', side_effect=send_batch):
+        on_schedule_tick()
+    assert state(third) == 'in_queue'
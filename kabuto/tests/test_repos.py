@@ -0,0 +1,45 @@
+import os
+import hgapi
+from kabuto.repos import RepoCache
+
+
+def make_repo(path, content):
+    os.makedirs(path)
+    with open(os.path.join(path, "Dockerfile"), "w") as fh:
+        fh.write(content)
+    repo = hgapi.hgapi.Repo(path)
+    repo.hg_init()
+    repo.hg_add()
+    repo.hg_commit("init", user='me')
+    return repo
+
+
+def test_repo_cache(tmpdir):
+    url = str(tmpdir.join("repo"))
+    repo = make_repo(url, "FROM busybox\n")
+    cache = RepoCache({'REPO_CACHE_DIR': str(tmpdir.join("mirrors")),
+                       'REPO_CACHE_SIZE': 1024 ** 3})
+
+    dest = tmpdir.mkdir("build1")
+    cache.checkout(url, str(dest))
+    assert dest.join("Dockerfile").read() == "FROM busybox\n"
+    assert not dest.join(".hg").exists()
+    assert os.path.isdir(os.path.join(cache.mirror_path(url), ".hg"))
+
+    tmpdir.join("repo", "Dockerfile").write("FROM scratch\n")
+    repo.hg_commit("update", user='me')
+    dest = tmpdir.mkdir("build2")
+    cache.checkout(url, str(dest))
+    assert dest.join("Dockerfile").read() == "FROM scratch\n"
+
+
+def test_repo_cache_eviction(tmpdir):
+    urls = [str(tmpdir.join("repo%s" % i)) for i in range(2)]
+    for url in urls:
+        make_repo(url, "FROM busybox\n")
+    cache = RepoCache({'REPO_CACHE_DIR': str(tmpdir.join("mirrors")),
+                       'REPO_CACHE_SIZE': 1})
+    for i, url in enumerate(urls):
+        cache.checkout(url, str(tmpdir.mkdir("build%s" % i)))
+    assert not os.path.exists(cache.mirror_path(urls[0]))
+    assert os.path.exists(cache.mirror_path(urls[1]))
@@ -1,8 +1,10 @@
-from kabuto.tasks import build_and_push, LogHandler, app
+from kabuto.tasks import (build_and_push, LogHandler, DockerClients, BuildLog,
+                          context_hash, app)
 from mock import patch
 from kabuto.tests.conftest import MockClient, ROOT_DIR
 import os
 import shutil
+import subprocess
 import hgapi
 import json
 
@@ -54,13 +56,39 @@ def test_build_and_push(authenticated_client):
     assert result['error'] == "Must provide a dockerfile or a repository"
 
 
+def test_context_hash_of_repository(tmpdir):
+    url = str(tmpdir.join("repo"))
+    os.makedirs(url)
+    tmpdir.join("repo", "Dockerfile").write("FROM busybox\n")
+    repo = hgapi.hgapi.Repo(url)
+    repo.hg_init()
+    repo.hg_add()
+    repo.hg_commit("init", user='me')
+    args = {"user": "user", "name": "name", "content": None, "url": url}
+    first = context_hash(args)
+    assert first and context_hash(args) == first
+
+    tmpdir.join("repo", "Dockerfile").write("FROM scratch\n")
+    repo.hg_commit("update", user='me')
+    assert context_hash(args) not in (None, first)
+
+    # a repository that does not answer in time is just not shared
+    with patch('subprocess.check_output',
+               side_effect=subprocess.TimeoutExpired("hg", 5)):
+        assert context_hash(args) is None
+
+
 class mockCh(object):
+    def __init__(self):
+        self.acks = []
+
     def basic_ack(self, *args, **kwargs):
-        pass
+        self.acks.append(kwargs)
 
 
 class mockMethod(object):
-    delivery_tag = None
+    def __init__(self, delivery_tag=None):
+        self.delivery_tag = delivery_tag
 
 
 def test_log_handler():
@@ -71,10 +99,154 @@ def test_log_handler():
     recipe = {'job_id': 1,
               'log_lines': ["log line 1\n", "log line 2\n"]}
     handler(mockCh(), mockMethod(), None, bytes(json.dumps(recipe), "utf-8"))
+    handler.tick()
 
     expected = """log line 1
 log line 2
 """
     with open(os.path.join(log_dir, "job_1.log")) as fh:
         assert expected == fh.read()
+    handler.writer.close(os.path.join(log_dir, "job_1.log"))
+    shutil.rmtree(log_dir)
+
+
+def test_log_handler_batches():
+    handler = LogHandler()
+    log_dir = os.path.join(ROOT_DIR, "data", "logs")
+    os.mkdir(log_dir)
+    app.config['JOB_LOGS_DIR'] = log_dir
+    handler.tick_interval = 60
+    ch = mockCh()
+    for tag in range(1, 4):
+        recipe = {'job_id': tag % 2,
+                  'log_lines': ["line %s\n" % tag]}
+        handler(ch, mockMethod(tag), None,
+                bytes(json.dumps(recipe), "utf-8"))
+    assert not ch.acks
+    assert not os.path.exists(os.path.join(log_dir, "job_1.log"))
+
+    handler.tick()
+    assert ch.acks == [{'delivery_tag': 3, 'multiple': True}]
+    with open(os.path.join(log_dir, "job_1.log")) as fh:
+        assert fh.read() == "line 1\nline 3\n"
+    with open(os.path.join(log_dir, "job_0.log")) as fh:
+        assert fh.read() == "line 2\n"
+    assert handler.writer.stats()["open_files"] == 2
+
+    handler.writer.max_open_files = 1
+    handler.writer.write(os.path.join(log_dir, "job_2.log"), ["line 4\n"])
+    handler.tick()
+    assert handler.writer.stats()["open_files"] == 1
+    assert ch.acks == [{'delivery_tag': 3, 'multiple': True}]
     shutil.rmtree(log_dir)
+
+
+def test_log_handler_write_errors():
+    handler = LogHandler()
+    log_dir = os.path.join(ROOT_DIR, "data", "logs")
+    os.mkdir(log_dir)
+    app.config['JOB_LOGS_DIR'] = log_dir
+    ch = mockCh()
+    handler.writer.write(os.path.join(log_dir, "gone", "job_1.log"),
+                         ["lost\n"])
+    recipe = {'job_id': 2, 'log_lines': ["kept\n"]}
+    handler(ch, mockMethod(1), None, bytes(json.dumps(recipe), "utf-8"))
+    handler.tick()
+    assert ch.acks == [{'delivery_tag': 1, 'multiple': True}]
+    assert handler.writer.stats()["buffered"] == 0
+    with open(os.path.join(log_dir, "job_2.log")) as fh:
+        assert fh.read() == "kept\n"
+
+    with patch.object(handler.writer, 'get_handle',
+                      side_effect=RuntimeError("boom")):
+        handler(ch, mockMethod(2), None, bytes(json.dumps(recipe), "utf-8"))
+        handler.tick()
+    assert ch.acks[-1] == {'delivery_tag': 2, 'multiple': True}
+    assert handler.writer.stats()["buffered"] == 0
+    handler.writer.close(os.path.join(log_dir, "job_2.log"))
+    shutil.rmtree(log_dir)
+
+
+class mockSender(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message, queue_name=None):
+        self.messages.append(message)
+
+
+def test_build_log():
+    sender = mockSender()
+    build_log = BuildLog("some_build", sender)
+    batch = app.config['BUILD_LOG_BATCH']
+    app.config['BUILD_LOG_BATCH'] = 2
+    build_log.write({"stream": "Step 1 : FROM scratch\n"})
+    assert not sender.messages
+    build_log.write("Successfully built")
+    app.config['BUILD_LOG_BATCH'] = batch
+    build_log.write({"status": "pushing"})
+    build_log.flush()
+    assert sender.messages == [
+        {"build_id": "some_build",
+         "log_lines": ["Step 1 : FROM scratch\n", "Successfully built\n"]},
+        {"build_id": "some_build", "log_lines": ["pushing\n"]}]
+
+    handler = LogHandler()
+    log_dir = os.path.join(ROOT_DIR, "data", "logs")
+    os.mkdir(log_dir)
+    app.config['JOB_LOGS_DIR'] = log_dir
+    for tag, message in enumerate(sender.messages):
+        handler(mockCh(), mockMethod(tag), None,
+                bytes(json.dumps(message), "utf-8"))
+    handler.tick()
+    with open(os.path.join(log_dir, "build_some_build.log")) as fh:
+        assert fh.read() == ("Step 1 : FROM scratch\nSuccessfully built\n"
+                             "pushing\n")
+    handler.writer.close(handler.build_log_path("some_build"))
+    shutil.rmtree(log_dir)
+
+
+class CountingClient(MockClient):
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        self.kwargs = kwargs
+        self.logins = 0
+        self.alive = True
+        self.instances.append(self)
+
+    def ping(self):
+        if not self.alive:
+            raise IOError("daemon gone")
+        return "OK"
+
+    def login(self, *args, **kwargs):
+        self.logins += 1
+
+
+@patch('docker.Client', CountingClient)
+def test_docker_client_cache():
+    config = dict(app.config)
+    config.update({'DOCKER_LOGIN': 'kabuto', 'DOCKER_PASSWORD': 'secret',
+                   'DOCKER_HEALTH_CHECK_INTERVAL': 0,
+                   'DOCKER_LOGIN_TTL': 3600, 'DOCKER_NUM_POOLS': 3})
+    clients = DockerClients(config)
+    client = clients.get()
+    assert clients.get() is client
+    assert client.kwargs['num_pools'] == 3
+    assert client.logins == 0
+
+    clients.login()
+    clients.login()
+    assert client.logins == 1
+    config['DOCKER_LOGIN_TTL'] = 0
+    clients.login()
+    assert client.logins == 2
+
+    client.alive = False
+    new_client = clients.get()
+    assert new_client is not client
+    assert len(CountingClient.instances) == 2
+
+    with patch('os.getpid', lambda: -1):
+        assert clients.get() is not new_client
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from kabuto.api import Job
+
+
+def upload_url(job, upload_id=None):
+    url = '/pipeline/%s/job/%s/uploads' % (job.pipeline_id, job.id)
+    if upload_id:
+        url = '%s/%s' % (url, upload_id)
+    return url
+
+
+def test_chunked_upload(preloaded_client):
+    job = Job.query.all()[-1]
+    payload = os.urandom(10000)
+    sha256 = hashlib.sha256(payload).hexdigest()
+
+    rv = preloaded_client.post(upload_url(job),
+                               data={'filename': 'data.bin',
+                                     'size': len(payload)})
+    upload_id = json.loads(rv.data.decode('utf-8'))['id']
+    url = upload_url(job, upload_id)
+
+    # chunks out of order, as parallel clients would send them
+    for offset in (6000, 0):
+        rv = preloaded_client.put('%s?offset=%s' % (url, offset),
+                                  data=payload[offset:offset + 3000],
+                                  content_type='application/octet-stream')
+        assert json.loads(rv.data.decode('utf-8'))['written'] == 3000
+
+    data = json.loads(preloaded_client.get(url).data.decode('utf-8'))
+    assert data['received'] == [[0, 3000], [6000, 9000]]
+    assert data['missing'] == [[3000, 6000], [9000, 10000]]
+
+    rv = preloaded_client.post(url, data={'sha256': sha256})
+    assert 'incomplete' in json.loads(rv.data.decode('utf-8'))['error']
+
+    # resume with what is missing
+    for start, stop in data['missing']:
+        preloaded_client.put('%s?offset=%s' % (url, start),
+                             data=payload[start:stop],
+                             content_type='application/octet-stream')
+
+    rv = preloaded_client.post(url, data={'sha256': '0' * 64})
+    assert 'mismatch' in json.loads(rv.data.decode('utf-8'))['error']
+
+    rv = preloaded_client.post(url, data={'sha256': sha256})
+    assert json.loads(rv.data.decode('utf-8'))['sha256'] == sha256
+    with open(os.path.join(job.attachments_path, 'data.bin'), 'rb') as fh:
+        assert fh.read() == payload
+    assert preloaded_client.get(url).status_code == 404
+
+
+def test_upload_out_of_bounds(preloaded_client):
+    job = Job.query.all()[-1]
+    rv = preloaded_client.post(upload_url(job),
+                               data={'filename': '../../escape.bin',
+                                     'size': 10})
+    upload_id = json.loads(rv.data.decode('utf-8'))['id']
+    url = upload_url(job, upload_id)
+
+    rv = preloaded_client.put('%s?offset=5' % url, data=b'x' * 10,
+                              content_type='application/octet-stream')
+    assert rv.status_code == 400
+    assert json.loads(rv.data.decode('utf-8'))['error']
+
+    preloaded_client.put('%s?offset=0' % url, data=b'x' * 10,
+                         content_type='application/octet-stream')
+    preloaded_client.post(url)
+    assert os.path.exists(os.path.join(job.attachments_path, 'escape.bin'))
+
+    assert preloaded_client.delete(upload_url(job, 'nope')).status_code == 404
+    # only ids shaped like the ones handed out get near the filesystem
+    for upload_id in ('..', '.uploads', upload_id.upper()):
+        rv = preloaded_client.get(upload_url(job, upload_id))
+        assert rv.status_code == 404
+
+    for filename in ('', '.', '..', 'some/..'):
+        rv = preloaded_client.post(upload_url(job),
+                                   data={'filename': filename, 'size': 10})
+        assert rv.status_code == 400
+        assert json.loads(rv.data.decode('utf-8'))['error']
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+
+from utils import logger
+
+UPLOAD_ID_RE = re.compile(
+    '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadSession(object):
+    # a resumable upload lives next to the job's inbox until it is
+    # finalized: the preallocated data file, its metadata and one
+    # marker per chunk written, so chunks can arrive in parallel and
+    # in any order without sharing any state but the filesystem
+    def __init__(self, folder, upload_id):
+        # the id ends up in paths, only what create() hands out is valid
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadError("Invalid upload id %s" % upload_id)
+        self.id = upload_id
+        self.folder = os.path.join(folder, upload_id)
+        self.data_path = os.path.join(self.folder, 'data.part')
+        self.meta_path = os.path.join(self.folder, 'meta.json')
+        self.chunks_path = os.path.join(self.folder, 'chunks')
+        self._meta = None
+
+    @classmethod
+    def create(cls, folder, filename, size, sha256=None):
+        filename = os.path.basename(filename or '')
+        if filename in ('', '.', '..'):
+            raise UploadError("A filename is required")
+        if size < 0:
+            raise UploadError("Invalid size %s" % size)
+        session = cls(folder, str(uuid.uuid4()))
+        os.makedirs(session.chunks_path)
+        with open(session.data_path, "wb") as fh:
+            fh.truncate(size)
+        with open(session.meta_path, "w") as fh:
+            json.dump({"filename": filename, "size": size,
+                       "sha256": sha256}, fh)
+        return session
+
+    @property
+    def exists(self):
+        return os.path.exists(self.meta_path)
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(self.meta_path) as fh:
+                self._meta = json.load(fh)
+        return self._meta
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    def write_chunk(self, offset, stream, chunk_size):
+        if offset < 0 or offset > self.size:
+            raise UploadError("Offset %s out of range" % offset)
+        written = 0
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            for data in iter(lambda: stream.read(chunk_size), b""):
+                if offset + written + len(data) > self.size:
+                    raise UploadError("Chunk goes past the end of the file")
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+        # the marker only exists once the whole chunk is on disk, an
+        # interrupted chunk simply shows up as missing
+        if written:
+            marker = "%s-%s" % (offset, offset + written)
+            open(os.path.join(self.chunks_path, marker), "w").close()
+        return written
+
+    def received(self):
+        chunks = []
+        for name in os.listdir(self.chunks_path):
+            start, stop = name.split('-')
+            chunks.append((int(start), int(stop)))
+        ranges = []
+        for start, stop in sorted(chunks):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        return ranges
+
+    def missing(self):
+        gaps = []
+        position = 0
+        for start, stop in self.received():
+            if start > position:
+                gaps.append([position, start])
+            position = max(position, stop)
+        if position < self.size:
+            gaps.append([position, self.size])
+        return gaps
+
+    def as_dict(self):
+        return {"id": self.id,
+                "filename": self.meta['filename'],
+                "size": self.size,
+                "received": self.received(),
+                "missing": self.missing()}
+
+    def checksum(self, chunk_size):
+        digest = hashlib.sha256()
+        with open(self.data_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def finalize(self, folder, chunk_size, sha256=None):
+        if self.missing():
+            raise UploadError("Upload is incomplete")
+        expected = sha256 or self.meta['sha256']
+        digest = self.checksum(chunk_size)
+        if expected and expected.lower() != digest:
+            raise UploadError("Checksum mismatch: expected %s, got %s" %
+                              (expected, digest))
+        path = os.path.join(folder, self.meta['filename'])
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.rename(self.data_path, path)
+        self.abort()
+        logger.info("Finalized upload %s into %s" % (self.id, path))
+        return digest
+
+    def abort(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
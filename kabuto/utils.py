@@ -1,17 +1,19 @@
 from contextlib import contextmanager
-from flask import Flask, current_app
+from flask import Flask, Request, current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from flask_ldap3_login import LDAP3LoginManager
 from flask_login import LoginManager
 from raven.contrib.flask import Sentry
+from directory import PooledLDAP3LoginManager
 import uuid
 import flask_restful as restful
 import pika
 import os
 import json
+import errno
 import tempfile
 import logging
+import time
 
 OVERRIDES = ('SECRET_KEY',
              'SQLALCHEMY_DATABASE_URI',
@@ -26,10 +28,37 @@ def read_config(config, key):
     config[key] = os.environ.get(key, config[key])
 
 
+class UploadRequest(Request):
+    # spool large uploads to named files so they can be linked into
+    # place instead of copied, see save_upload
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if total_content_length is None or total_content_length > 1024 * 500:
+            folder = current_app.config.get('UPLOAD_SPOOL_DIR') or None
+            return tempfile.NamedTemporaryFile('wb+', dir=folder,
+                                               prefix='kabuto-upload-')
+        return super(UploadRequest, self)._get_file_stream(
+            total_content_length, content_type, filename, content_length)
+
+
+@contextmanager
+def open_channel(config):
+    credentials = pika.PlainCredentials(config['AMQP_USER'],
+                                        config['AMQP_PASSWORD'])
+    parameters = pika.ConnectionParameters(host=config['AMQP_HOSTNAME'],
+                                           credentials=credentials)
+    connection = pika.BlockingConnection(parameters)
+    try:
+        yield connection.channel()
+    finally:
+        connection.close()
+
+
 def make_app(config=None):
     if not config:
         config = 'config.Config'
     app = Flask(__name__)
+    app.request_class = UploadRequest
     app.config.from_object(config)
     app.config.from_envvar('KABUTO_CONFIG', silent=True)
     for key in OVERRIDES:
@@ -39,7 +68,7 @@ def make_app(config=None):
     login_manager = LoginManager(app)
     ldap_manager = None
     if app.config['LDAP_HOST']:
-        ldap_manager = LDAP3LoginManager(app)
+        ldap_manager = PooledLDAP3LoginManager(app)
     db = SQLAlchemy(app)
     bcrypt = Bcrypt(app)
     if app.config['SENTRY_DSN']:
@@ -57,3 +86,48 @@ def get_working_dir(prefix=''):
         os.mkdir(path)
         return path
     return tempfile.mkdtemp(prefix=prefix)
+
+
+class FileSlice(object):
+    # file-like view on the next `length` bytes of fh, keeps fileno()
+    # so servers can still sendfile() from the current offset
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.remaining = length
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+
+def save_upload(filestorage, path):
+    start = time.time()
+    if os.path.lexists(path):
+        os.unlink(path)
+    stream = filestorage.stream
+    linked = False
+    if isinstance(getattr(stream, 'name', None), str):
+        stream.flush()
+        try:
+            os.link(stream.name, path)
+            linked = True
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.ENOENT):
+                raise
+    if not linked:
+        filestorage.save(path, current_app.config['UPLOAD_CHUNK_SIZE'])
+    size = os.path.getsize(path)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info("Saved upload %s: %s bytes in %.3fs (%.1f MB/s, %s)" % (
+        path, size, elapsed, size / elapsed / 1024**2,
+        "linked" if linked else "copied"))
+    return size